@@ -0,0 +1,378 @@
+"""送货单解析和入库的基准测试
+
+用法：
+    python benchmark.py                     # 生成合成工作簿并运行全部基准，与基线比较
+    python benchmark.py --save-baseline     # 运行并把结果保存为新的基线
+    python benchmark.py generate out.xlsx --notes 200 --rows 30 --sheets 2 --noise 0.1
+    python benchmark.py readers             # 比较已安装的 Excel 读取引擎
+    python benchmark.py matcher             # 关键词匹配的微基准（逐个 in 判断 vs 预编译匹配器）
+
+另外在子进程中测量冷启动：导入 exceldemo3 和 lifespan 启动（建库、迁移）的耗时。
+
+数据库使用临时目录中的 SQLite（通过 DATABASE_URL 环境变量替代 MySQL），不影响正式数据库。
+
+仓库中的 benchmark_baseline.json 是按默认参数（见其中的 config）运行 --save-baseline 得到的，
+耗时与机器有关：在另一台机器上比较前，先在该机器上用改动前的代码运行 --save-baseline 生成自己的基线。
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import contextlib
+import statistics
+from typing import List, Dict, Any, Callable, Optional
+
+import openpyxl
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+PRODUCT_HEADER = ['序号', '商品名称', '单位', '订货数量', '原始单价', '折扣率', '执行单价', '金额']
+PRODUCT_NAMES = ['白菜', '土豆', '西红柿', '黄瓜', '鸡蛋', '猪肉', '牛肉', '大米', '面粉', '豆腐',
+                 '菠菜', '芹菜', '胡萝卜', '茄子', '青椒', '洋葱', '大蒜', '生姜', '苹果', '香蕉']
+UNITS = ['斤', '个', '袋', '箱', '盒']
+
+
+def generate_workbook(path: str, notes: int = 100, rows: int = 30, sheets: int = 1,
+                      noise: float = 0.0, seed: int = 1) -> int:
+    """生成与真实送货单版式一致的合成工作簿，返回生成的商品行数
+
+    每个送货单包含 标题、送货时间、订货单位/送货单位、列名、商品行、合计行、制单员行。
+    noise 为 0~1 的比例：商品行的数值写成带单位或无法解析的文本，送货单之间插入空行和备注行。
+    """
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    product_rows = 0
+
+    for sheet_index in range(sheets):
+        worksheet = workbook.create_sheet(f'Sheet{sheet_index + 1}')
+        for note_index in range(notes):
+            worksheet.append(['某某中学  送货单'])
+            worksheet.append(['送货时间：', f'2025年9月{note_index % 28 + 1}日'])
+            worksheet.append([f'订货单位：学校{note_index % 7}', None, None, None, f'送货单位：合作社{note_index % 3}'])
+            worksheet.append(PRODUCT_HEADER)
+            for row_index in range(rows):
+                price = round(rng.uniform(1, 30), 2)
+                quantity = rng.choice([1, 2, 5, 10, 3.5])
+                discount = 0.9
+                settlement_price = round(price * discount, 2)
+                amount = round(settlement_price * quantity, 2)
+                if rng.random() < noise:
+                    # 带单位或货币符号的数值，以及少量无法解析的值
+                    quantity = rng.choice([f'{quantity}斤', 'x'])
+                    discount = '90%'
+                    amount = f'¥{amount}'
+                worksheet.append([row_index + 1, f'{rng.choice(PRODUCT_NAMES)}{rng.randint(0, 9)}', rng.choice(UNITS),
+                                  quantity, price, discount, settlement_price, amount])
+                product_rows += 1
+            worksheet.append(['合计', None, None, None, None, None, None, None])
+            worksheet.append(['制单员：', '张三', None, '验收人：', None, None, '客户：'])
+            if rng.random() < noise:
+                worksheet.append([])
+                worksheet.append(['备注：', '请核对数量'])
+
+    workbook.save(path)
+    return product_rows
+
+
+# 在子进程中测量冷启动：导入 exceldemo3 的耗时，以及 lifespan 启动（建库、迁移）的耗时
+STARTUP_SCRIPT = """
+import sys, time, asyncio
+started = time.perf_counter()
+import exceldemo3
+imported = time.perf_counter()
+
+async def start():
+    async with exceldemo3.lifespan(exceldemo3.app):
+        pass
+
+asyncio.run(start())
+print(imported - started, time.perf_counter() - imported, 'pandas' in sys.modules)
+"""
+
+
+def time_startup(work_dir: str, repeat: int) -> Dict[str, List[float]]:
+    """重复启动子进程，返回导入和 lifespan 启动的耗时列表"""
+    timings = {'import_exceldemo3': [], 'startup_lifespan': []}
+    for index in range(repeat):
+        env = dict(os.environ,
+                   DATABASE_URL=f"sqlite:///{os.path.join(work_dir, f'startup{index}.db')}",
+                   UPLOAD_DIR=os.path.join(work_dir, 'excelfile'))
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.split()
+        timings['import_exceldemo3'].append(float(output[0]))
+        timings['startup_lifespan'].append(float(output[1]))
+        if output[2] == 'True':
+            print("警告: 导入 exceldemo3 时加载了 pandas")
+    return timings
+
+
+def time_call(function: Callable, repeat: int, setup: Optional[Callable] = None) -> List[float]:
+    """重复调用 function，返回每次的耗时（秒），被测函数的输出不打印；setup 在每次调用前执行，不计时"""
+    timings = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+            started = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started)
+    return timings
+
+
+def import_exceldemo3(work_dir: str):
+    """使用临时目录中的 SQLite 数据库导入 exceldemo3"""
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(work_dir, 'bench.db')}"
+    os.environ.setdefault('DB_ASYNC', '0')
+    # 解析耗时不经过解析结果缓存；read_parsed_cache 单独计时
+    os.environ.setdefault('PARSED_CACHE', '0')
+    os.environ['PARSED_CACHE_DIR'] = os.path.join(work_dir, 'parsed')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with contextlib.redirect_stdout(io.StringIO()):
+        import exceldemo3
+    return exceldemo3
+
+
+# 读取引擎对比使用的工作簿规模：名称 -> (每个工作表的送货单数, 每个送货单的商品行数, 工作表数)
+READER_SHAPES = {
+    'small': (20, 10, 1),
+    'medium': (200, 30, 2),
+    'large': (1000, 30, 2),
+}
+
+
+def benchmark_readers(args) -> int:
+    """在不同规模的合成工作簿上比较已安装的读取引擎（打开工作簿 + 读取工作表 + 扫描）"""
+    work_dir = tempfile.mkdtemp(prefix='shenpangzi-bench-')
+    exceldemo3 = import_exceldemo3(work_dir)
+    missing = [name for name in exceldemo3.READER_ENGINES if name not in exceldemo3.available_reader_engines()]
+    if missing:
+        print(f"未安装的读取引擎: {', '.join(missing)}")
+
+    print(f"{'规模':<8} {'引擎':<20} {'读取(s)':>10} {'总耗时(s)':>10} {'吞吐(行/s)':>12}")
+    for shape, (notes, rows, sheets) in READER_SHAPES.items():
+        path = os.path.join(work_dir, f'{shape}.xlsx')
+        product_rows = generate_workbook(path, notes, rows, sheets, args.noise, args.seed)
+        for engine in exceldemo3.available_reader_engines(path):
+            read_timings = []
+
+            def scan():
+                timings = {}
+                for _ in exceldemo3.scan_workbook(path, engine, timings):
+                    pass
+                read_timings.append(timings.get('workbook_open', 0.0) + timings.get('sheet_read', 0.0))
+
+            total = statistics.median(time_call(scan, args.repeat))
+            print(f"{shape:<8} {engine:<20} {statistics.median(read_timings):>10.4f} {total:>10.4f} "
+                  f"{product_rows / total:>12.1f}")
+    return 0
+
+
+def benchmark_matcher(args) -> int:
+    """在不同宽度的行上比较逐个关键词 in 判断与预编译的 KeywordMatcher"""
+    work_dir = tempfile.mkdtemp(prefix='shenpangzi-bench-')
+    exceldemo3 = import_exceldemo3(work_dir)
+    rng = random.Random(args.seed)
+
+    def naive_count(text):
+        return sum(1 for keyword in exceldemo3.DELIVERY_NOTE_KEYWORDS if keyword in text)
+
+    def naive_terminator(text):
+        return any(keyword in text for keyword in exceldemo3.PRODUCT_TERMINATORS)
+
+    def naive_column(text):
+        return next((keyword for keyword in exceldemo3.PRODUCT_COLUMN_KEYWORDS if keyword in text), None)
+
+    cases = [
+        ('表头识别', naive_count, exceldemo3.delivery_note_keyword_count),
+        ('结束行识别', naive_terminator, exceldemo3.TERMINATOR_MATCHER.search),
+        ('列映射', naive_column, exceldemo3.PRODUCT_COLUMN_MATCHER.first),
+    ]
+
+    print(f"{'检查':<10} {'列数':>6} {'逐个 in(µs/行)':>16} {'匹配器(µs/行)':>16} {'加速':>8}")
+    for width in (8, 50, 200):
+        # 大多数为不含关键词的数据行，少量为表头行
+        rows = []
+        for index in range(200):
+            cells = [f'{rng.choice(PRODUCT_NAMES)}{rng.randint(0, 99)}' if column % 2 else str(rng.uniform(1, 100))
+                     for column in range(width)]
+            if index % 50 == 0:
+                cells[:len(PRODUCT_HEADER)] = PRODUCT_HEADER
+            rows.append(' '.join(cells))
+
+        for name, naive, matcher in cases:
+            for text in rows:
+                assert bool(naive(text)) == bool(matcher(text))
+            naive_seconds = min(time_call(lambda: [naive(text) for text in rows], args.repeat))
+            matcher_seconds = min(time_call(lambda: [matcher(text) for text in rows], args.repeat))
+            print(f"{name:<10} {width:>6} {naive_seconds / len(rows) * 1e6:>16.2f} "
+                  f"{matcher_seconds / len(rows) * 1e6:>16.2f} {naive_seconds / matcher_seconds:>7.1f}x")
+    return 0
+
+
+def run_benchmarks(args) -> Dict[str, Dict[str, Any]]:
+    work_dir = tempfile.mkdtemp(prefix='shenpangzi-bench-')
+    startup_timings = time_startup(work_dir, args.repeat)
+
+    exceldemo3 = import_exceldemo3(work_dir)
+    import pandas as pd
+
+    engine = exceldemo3.get_engine()
+    exceldemo3.run_migrations(engine)
+
+    workbook_path = os.path.join(work_dir, 'bench.xlsx')
+    product_rows = generate_workbook(workbook_path, args.notes, args.rows, args.sheets, args.noise, args.seed)
+    print(f"合成工作簿: {args.sheets} 个工作表 x {args.notes} 个送货单 x {args.rows} 行，"
+          f"共 {product_rows} 个商品行，{os.path.getsize(workbook_path)} 字节")
+
+    results = {}
+
+    def record(name: str, timings: List[float], items: int):
+        median = statistics.median(timings)
+        results[name] = {
+            'median_seconds': round(median, 6),
+            'min_seconds': round(min(timings), 6),
+            'items': items,
+            'items_per_second': round(items / median, 1) if median > 0 else None
+        }
+
+    # 冷启动（每秒可启动的进程数）
+    for name, timings in startup_timings.items():
+        record(name, timings, 1)
+
+    # 解析 + 入库整个文件；每次前清空已入库内容记录，否则重复的内容会跳过保存
+    def forget_ingested_content():
+        with engine.begin() as conn:
+            conn.execute(exceldemo3.delete(exceldemo3.IngestedContent.__table__))
+
+    record('process_excel_file', time_call(lambda: exceldemo3.process_excel_file(workbook_path), args.repeat,
+                                           forget_ingested_content), product_rows)
+
+    # 识别送货单并提取商品（入库时 pandas 读取的工作表走的路径，不含读取 Excel）
+    sheets = pd.read_excel(workbook_path, sheet_name=None)
+    sheet_rows = sum(len(df) for df in sheets.values())
+    record('scan_sheet',
+           time_call(lambda: [exceldemo3.scan_sheet(df) for df in sheets.values()], args.repeat),
+           sheet_rows)
+
+    # 整个文件的送货单在一个事务中保存到数据库（入库时走的路径，不记录内容哈希，可以重复保存）
+    with contextlib.redirect_stdout(io.StringIO()):
+        parsed = exceldemo3.parse_excel_file(workbook_path)
+    saved_rows = sum(len(note['products']) for note in parsed['delivery_notes'])
+    record('save_file_to_database', time_call(
+        lambda: exceldemo3.save_file_to_database(parsed['file_name'], parsed['delivery_notes']), args.repeat),
+        saved_rows)
+
+    # 从解析结果的列式缓存读取（需要安装 pyarrow），对比 process_excel_file 中解析 Excel 的耗时
+    if exceldemo3._module_available('pyarrow'):
+        sha256 = exceldemo3.file_sha256(workbook_path)
+        exceldemo3.write_parsed_cache(sha256, parsed)
+        record('read_parsed_cache', time_call(lambda: exceldemo3.read_parsed_cache(sha256), args.repeat), saved_rows)
+
+    # 价格不一致检查（/check-price-inconsistencies 的查询部分）
+    def check_price_inconsistencies():
+        db = exceldemo3.SessionLocal()
+        try:
+            return exceldemo3.find_price_inconsistencies(db)
+        finally:
+            db.close()
+
+    with engine.connect() as conn:
+        total_rows = conn.execute(exceldemo3.select(exceldemo3.func.count())
+                                  .select_from(exceldemo3.HongshanShixiaoDelivery.__table__)).scalar()
+    record('check_price_inconsistencies', time_call(check_price_inconsistencies, args.repeat), total_rows)
+
+    exceldemo3.dispose_engines()
+    return results
+
+
+def compare_with_baseline(results: Dict[str, Dict[str, Any]], config: Dict[str, Any],
+                          baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """打印与基线的对比，返回变慢超过 threshold 的基准名称"""
+    if baseline.get('config') != config:
+        print(f"基线的参数 {baseline.get('config')} 与本次 {config} 不同，结果仅供参考")
+
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        ratio = result['median_seconds'] / base['median_seconds'] if base['median_seconds'] else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  <-- 变慢'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = '  (变快)'
+        print(f"  {name:<30} 基线 {base['median_seconds']:.4f}s -> {result['median_seconds']:.4f}s "
+              f"({ratio:.2f}x){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="送货单解析和入库基准测试")
+    subparsers = parser.add_subparsers(dest='command')
+
+    generate_parser = subparsers.add_parser('generate', help="只生成合成工作簿")
+    generate_parser.add_argument('path')
+    readers_parser = subparsers.add_parser('readers', help="比较已安装的 Excel 读取引擎")
+    readers_parser.add_argument('--repeat', type=int, default=3, help="每个引擎的重复次数（取中位数）")
+    matcher_parser = subparsers.add_parser('matcher', help="关键词匹配的微基准")
+    matcher_parser.add_argument('--repeat', type=int, default=20, help="重复次数（取最短耗时）")
+
+    for target in (parser, generate_parser):
+        target.add_argument('--notes', type=int, default=100, help="每个工作表的送货单数")
+        target.add_argument('--rows', type=int, default=30, help="每个送货单的商品行数")
+        target.add_argument('--sheets', type=int, default=1, help="工作表数")
+        target.add_argument('--noise', type=float, default=0.1, help="带单位/无法解析的数值和多余行的比例（0~1）")
+        target.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5, help="每个基准的重复次数（取中位数）")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="基线文件路径")
+    parser.add_argument('--save-baseline', action='store_true', help="把本次结果保存为基线")
+    parser.add_argument('--threshold', type=float, default=0.2, help="中位耗时超过基线该比例视为变慢")
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        product_rows = generate_workbook(args.path, args.notes, args.rows, args.sheets, args.noise, args.seed)
+        print(f"已生成 {args.path}，共 {product_rows} 个商品行")
+        return 0
+    if args.command == 'readers':
+        return benchmark_readers(args)
+    if args.command == 'matcher':
+        return benchmark_matcher(args)
+
+    config = {key: getattr(args, key) for key in ('notes', 'rows', 'sheets', 'noise', 'seed')}
+    results = run_benchmarks(args)
+
+    print(f"{'基准':<30} {'中位耗时(s)':>12} {'最短耗时(s)':>12} {'吞吐(行/s)':>12}")
+    for name, result in results.items():
+        print(f"{name:<30} {result['median_seconds']:>12.4f} {result['min_seconds']:>12.4f} "
+              f"{result['items_per_second'] or 0:>12.1f}")
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print("与基线比较:")
+        regressions = compare_with_baseline(results, config, baseline, args.threshold)
+    elif not args.save_baseline:
+        print(f"没有找到基线文件 {args.baseline}，可先运行 python benchmark.py --save-baseline 生成")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'config': config, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存到 {args.baseline}")
+
+    if regressions:
+        print(f"以下基准变慢超过 {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,41 @@
+from __future__ import annotations
+
 import os
-import pandas as pd
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import asyncio
+import time
+import uuid
+import tempfile
+import hashlib
+import threading
+from collections import Counter, OrderedDict, deque
+import math
+import importlib
+import importlib.util
+import functools
+import multiprocessing
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Query, Request, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict, Any
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
+from typing import List, Dict, Any, Optional, Tuple
 import re
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Date, Numeric, TIMESTAMP
+import json
+import base64
+from datetime import datetime, date
+import sys
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy import create_engine, inspect, insert, update, delete, select, func, tuple_, bindparam, text
+from sqlalchemy import Column, Integer, String, Date, Numeric, TIMESTAMP, Index, Table
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import pymysql
+from sqlalchemy.orm import sessionmaker, aliased
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 import logging
 
@@ -19,27 +46,164 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# 逐行/逐个送货单的调试日志采样：每个位置只输出第 1 条及之后每 LOG_SAMPLE_EVERY 条
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', 100))
+_log_sample_counts = Counter()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+
+def log_sampled(key: str, message: str, *args):
+    """按 key 采样输出 debug 日志，未开启 DEBUG 时不做任何格式化"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    count = _log_sample_counts[key]
+    _log_sample_counts[key] = count + 1
+    if count % LOG_SAMPLE_EVERY == 0:
+        logger.debug(message, *args)
+
+
+class LazyModule:
+    """首次访问属性时才导入的模块
+
+    pandas 和 openpyxl 导入较慢，且只在解析 Excel 时使用（通常在入库子进程中），
+    接口进程启动时不导入。访问过的属性缓存在实例上，之后不再经过 __getattr__。
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        value = getattr(self.load(), attr)
+        setattr(self, attr, value)
+        return value
+
+
+pd = LazyModule('pandas')
+openpyxl = LazyModule('openpyxl')
+pa = LazyModule('pyarrow')
+pq = LazyModule('pyarrow.parquet')
+
+router = APIRouter()
 
 # MySQL数据库配置
-MYSQL_HOST = "localhost"
-MYSQL_PORT = 3306
-MYSQL_USER = "root"
-MYSQL_PASSWORD = "root"
-MYSQL_DB = "shenpangzi"
+MYSQL_HOST = os.getenv('MYSQL_HOST', "localhost")
+MYSQL_PORT = int(os.getenv('MYSQL_PORT', 3306))
+MYSQL_USER = os.getenv('MYSQL_USER', "root")
+MYSQL_PASSWORD = os.getenv('MYSQL_PASSWORD', "root")
+MYSQL_DB = os.getenv('MYSQL_DB', "shenpangzi")
+
+# 连接池配置
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1').lower() not in ('0', 'false', 'no')
+
+# 读接口是否使用异步数据库驱动（aiomysql，本地 SQLite 时为 aiosqlite）
+DB_ASYNC = os.getenv('DB_ASYNC', '0').lower() in ('1', 'true', 'yes')
+
+# 创建数据库连接（DATABASE_URL 可通过环境变量覆盖，例如本地使用 sqlite:///shenpangzi.db）
+DATABASE_URL = os.getenv(
+    'DATABASE_URL', f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}")
+
+
+def engine_options(url: str) -> Dict[str, Any]:
+    """连接池参数，SQLite 使用 SQLAlchemy 默认的连接池"""
+    if url.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+def async_database_url(url: str) -> str:
+    """把同步驱动的连接地址转换为对应的异步驱动"""
+    for sync_prefix, async_prefix in (('mysql+pymysql://', 'mysql+aiomysql://'), ('mysql://', 'mysql+aiomysql://'),
+                                      ('sqlite:///', 'sqlite+aiosqlite:///')):
+        if url.startswith(sync_prefix):
+            return async_prefix + url[len(sync_prefix):]
+    return url
+
+
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL', async_database_url(DATABASE_URL))
+
+# 数据库引擎在第一次使用时创建（导入模块时不连接数据库）
+_engine = None
+_session_factory = None
+_async_engine = None
+_async_session_factory = None
+
+
+def get_engine():
+    """获取（首次使用时创建）同步数据库引擎"""
+    global _engine, _session_factory
+    if _engine is None:
+        _engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+        _session_factory = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
+    return _engine
+
+
+def SessionLocal():
+    """创建一个同步数据库会话"""
+    get_engine()
+    return _session_factory()
+
+
+def get_async_session_factory():
+    """获取（首次使用时创建）异步会话工厂，未开启 DB_ASYNC 时返回 None"""
+    global _async_engine, _async_session_factory
+    if DB_ASYNC and _async_session_factory is None:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+        _async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+        _async_session_factory = async_sessionmaker(_async_engine, autoflush=False, expire_on_commit=False)
+    return _async_session_factory
+
+
+def dispose_engines():
+    """关闭数据库连接池，下次使用时重新创建"""
+    global _engine, _session_factory
+    if _engine is not None:
+        _engine.dispose()
+        _engine = _session_factory = None
+
+
+async def dispose_async_engine():
+    global _async_engine, _async_session_factory
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = _async_session_factory = None
 
-# 创建数据库连接
-DATABASE_URL = f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}"
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async def get_db():
+    """每个请求一个数据库会话（依赖注入），DB_ASYNC 时为异步会话"""
+    async_session_factory = get_async_session_factory()
+    if async_session_factory is not None:
+        async with async_session_factory() as session:
+            yield session
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            await run_in_threadpool(db.close)
+
+
+async def run_db(db, function, *args, **kwargs):
+    """在请求的会话上执行同步的查询函数，不阻塞事件循环
+
+    异步会话通过 run_sync 使用异步驱动执行，同步会话放到线程池中执行。
+    """
+    if hasattr(db, 'run_sync'):
+        return await db.run_sync(lambda session: function(session, *args, **kwargs))
+    return await run_in_threadpool(function, db, *args, **kwargs)
 
 Base = declarative_base()
 
@@ -62,347 +226,1928 @@ class HongshanShixiaoDelivery(Base):
     discount_rate = Column(Numeric(5, 2), nullable=False, comment='折扣率(%)')
     settlement_price = Column(Numeric(10, 2), nullable=False, comment='结算价')
     amount = Column(Numeric(12, 2), nullable=False, comment='金额')
-    created_time = Column(TIMESTAMP, server_default='CURRENT_TIMESTAMP', comment='创建时间')
-    updated_time = Column(TIMESTAMP, server_default='CURRENT_TIMESTAMP', onupdate='CURRENT_TIMESTAMP',
+    created_time = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'), comment='创建时间')
+    updated_time = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'), onupdate='CURRENT_TIMESTAMP',
                           comment='更新时间')
 
+    __table_args__ = (
+        # 价格不一致检查：按日期+商品分组并统计结算价（覆盖索引）
+        Index('idx_delivery_date_product_price', 'delivery_date', 'product_name', 'settlement_price'),
+        # 商品价格历史：按商品查询并按日期排序
+        Index('idx_product_date', 'product_name', 'delivery_date'),
+        # 按文件清理数据
+        Index('idx_file_name', 'file_name'),
+    )
+
+
+class PriceSummary(Base):
+    """价格汇总：每天每个商品的不同结算价个数和记录数，随入库增量维护"""
+    __tablename__ = 'price_summary'
+
+    delivery_date = Column(Date, primary_key=True, comment='送货日期')
+    product_name = Column(String(100), primary_key=True, comment='商品名称')
+    price_count = Column(Integer, nullable=False, default=0, comment='不同结算价个数')
+    record_count = Column(Integer, nullable=False, default=0, comment='记录数')
+    min_price = Column(Numeric(10, 2), nullable=True, comment='最低结算价')
+    max_price = Column(Numeric(10, 2), nullable=True, comment='最高结算价')
+
+    __table_args__ = (
+        # price_count > 1 即为价格不一致
+        Index('idx_price_count', 'price_count'),
+    )
+
+
+class PriceSummaryPrice(Base):
+    """价格汇总明细：每天每个商品每个结算价的记录数"""
+    __tablename__ = 'price_summary_price'
+
+    delivery_date = Column(Date, primary_key=True, comment='送货日期')
+    product_name = Column(String(100), primary_key=True, comment='商品名称')
+    settlement_price = Column(Numeric(10, 2), primary_key=True, comment='结算价')
+    record_count = Column(Integer, nullable=False, default=0, comment='记录数')
+
+
+class DailyPriceRollup(Base):
+    """每日价格汇总：每天每个商品在每个订货单位/送货单位的结算价统计，随入库增量维护"""
+    __tablename__ = 'daily_price_rollup'
+
+    product_name = Column(String(100), primary_key=True, comment='商品名称')
+    delivery_date = Column(Date, primary_key=True, comment='送货日期')
+    ordering_unit = Column(String(100), primary_key=True, comment='订货单位')
+    delivery_unit = Column(String(100), primary_key=True, comment='送货单位')
+    record_count = Column(Integer, nullable=False, default=0, comment='记录数')
+    price_sum = Column(Numeric(16, 2), nullable=False, default=0, comment='结算价合计')
+    min_price = Column(Numeric(10, 2), nullable=False, comment='最低结算价')
+    max_price = Column(Numeric(10, 2), nullable=False, comment='最高结算价')
+    latest_price = Column(Numeric(10, 2), nullable=False, comment='最近入库的结算价')
+    last_ingested = Column(TIMESTAMP, nullable=True, comment='最近入库时间')
+
+
+class UploadManifest(Base):
+    """上传文件清单：文件名 -> 文件内容的 SHA-256（文件按内容保存在 UPLOAD_DIR/objects 下）"""
+    __tablename__ = 'upload_manifest'
+
+    file_name = Column(String(255), primary_key=True, comment='文件名')
+    sha256 = Column(String(64), nullable=False, comment='文件内容的 SHA-256')
+    size = Column(Integer, nullable=False, comment='文件大小（字节）')
+    uploaded_time = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'), comment='上传时间')
+
+    __table_args__ = (
+        Index('idx_manifest_sha256', 'sha256'),
+    )
+
+
+class IngestedContent(Base):
+    """已入库的文件内容：同样内容的文件（不论文件名）再次上传时跳过解析和入库"""
+    __tablename__ = 'ingested_content'
+
+    sha256 = Column(String(64), primary_key=True, comment='文件内容的 SHA-256')
+    file_name = Column(String(255), nullable=False, comment='入库时的文件名')
+    rows = Column(Integer, nullable=False, default=0, comment='入库的商品行数')
+    ingested_time = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'), comment='入库时间')
+
+
+# 已执行的数据库迁移版本
+schema_migrations = Table(
+    'schema_migrations', Base.metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('description', String(255), nullable=False),
+    Column('applied_time', TIMESTAMP, server_default=text('CURRENT_TIMESTAMP')),
+)
 
-# 创建表（如果不存在）
-Base.metadata.create_all(bind=engine)
 
-UPLOAD_DIR = "excelfile"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+def _migration_create_delivery_table(conn):
+    HongshanShixiaoDelivery.__table__.create(conn, checkfirst=True)
 
 
+def _migration_create_delivery_indexes(conn):
+    for index in HongshanShixiaoDelivery.__table__.indexes:
+        index.create(conn, checkfirst=True)
 
-def is_delivery_note_header(row: pd.Series) -> bool:
-    """检查行是否为送货单表头"""
-    row_text = ' '.join(str(cell) for cell in row.values if pd.notna(cell))
 
-    # 送货单关键词
-    delivery_keywords = [
-        '送货单', '送货时间', '订货单位', '送货单位',
-        '商品名称', '品名', '名称', '序号', '规格',
-        '订货数量', '数量', '单位', '原始单价', '报价',
-        '折扣率', '执行单价', '结算价', '金额'
-    ]
+def _migration_create_price_summary(conn):
+    PriceSummary.__table__.create(conn, checkfirst=True)
+    PriceSummaryPrice.__table__.create(conn, checkfirst=True)
+    rebuild_price_summary(conn)
 
-    # 检查是否包含足够多的送货单关键词
-    keyword_count = sum(1 for keyword in delivery_keywords if keyword in row_text)
-    return keyword_count >= 3  # 至少包含3个关键词才认为是送货单表头
 
+def _migration_add_price_range(conn):
+    existing = {column['name'] for column in inspect(conn).get_columns('price_summary')}
+    for name in ('min_price', 'max_price'):
+        if name not in existing:
+            column_type = PriceSummary.__table__.c[name].type.compile(dialect=conn.dialect)
+            conn.execute(text(f'ALTER TABLE price_summary ADD COLUMN {name} {column_type} NULL'))
+    rebuild_price_summary(conn)
 
-def find_delivery_notes(df: pd.DataFrame) -> List[Dict[str, Any]]:
-    """在数据框中查找所有送货单"""
-    delivery_notes = []
-    current_note = None
-    start_row = -1
 
-    print(f"数据框形状: {df.shape}")
+def _migration_create_daily_price_rollup(conn):
+    DailyPriceRollup.__table__.create(conn, checkfirst=True)
+    rebuild_price_rollups(conn)
 
-    for i, row in df.iterrows():
-        row_text = ' '.join(str(cell) for cell in row.values if pd.notna(cell))
 
-        # 检查是否为送货单表头（订货单位行）
-        if '订货单位：' in row_text:
-            print(f"找到送货单表头在第 {i} 行: {row_text}")
+def _migration_create_upload_manifest(conn):
+    UploadManifest.__table__.create(conn, checkfirst=True)
+    IngestedContent.__table__.create(conn, checkfirst=True)
 
-            if current_note is not None:
-                delivery_notes.append({
-                    'start_row': start_row,
-                    'end_row': i - 1,
-                    'info': current_note
-                })
 
-            # 初始化送货单信息
-            current_note = {
-                'delivery_date': None,
-                'order_unit': None,
-                'delivery_unit': None
-            }
+# 数据库迁移，按版本号顺序执行；已发布的迁移不要修改，只能追加
+MIGRATIONS = [
+    (1, '创建 hongshan_shixiao_delivery 表', _migration_create_delivery_table),
+    (2, '为 hongshan_shixiao_delivery 添加查询索引', _migration_create_delivery_indexes),
+    (3, '创建价格汇总表并回填', _migration_create_price_summary),
+    (4, '价格汇总表增加最低/最高结算价', _migration_add_price_range),
+    (5, '创建每日价格汇总表并回填', _migration_create_daily_price_rollup),
+    (6, '创建上传文件清单和已入库内容表', _migration_create_upload_manifest),
+]
 
-            # 提取订货单位和送货单位
-            order_match = re.search(r'订货单位[：:]\s*(.+)', row_text)
-            if order_match:
-                current_note['order_unit'] = order_match.group(1).strip()
 
-            delivery_match = re.search(r'送货单位[：:]\s*(.+)', row_text)
-            if delivery_match:
-                current_note['delivery_unit'] = delivery_match.group(1).strip()
+def run_migrations(bind=None) -> List[int]:
+    """执行尚未执行的数据库迁移，可重复调用，返回本次执行的版本号"""
+    bind = bind or get_engine()
+    schema_migrations.create(bind, checkfirst=True)
+    with bind.connect() as conn:
+        applied = set(conn.execute(select(schema_migrations.c.version)).scalars())
 
-            start_row = i + 2  # 数据从表头行的下两行开始
-            print(f"商品数据从第 {start_row} 行开始")
+    executed = []
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        # 每个迁移在单独的事务中执行，并记录版本号
+        with bind.begin() as conn:
+            migrate(conn)
+            conn.execute(insert(schema_migrations).values(version=version, description=description))
+        logger.info(f"已执行数据库迁移 {version}: {description}")
+        executed.append(version)
+    return executed
+
+# 上传文件保存目录，在应用启动时创建；文件按内容保存在其下的 objects 目录
+UPLOAD_DIR = os.getenv('UPLOAD_DIR', "excelfile")
+UPLOAD_OBJECT_DIR = 'objects'
+
+# 上传限制：单个文件和单次请求的最大字节数，以及写入磁盘的块大小
+MAX_UPLOAD_FILE_SIZE = int(os.getenv('MAX_UPLOAD_FILE_SIZE', 50 * 1024 * 1024))
+MAX_UPLOAD_REQUEST_SIZE = int(os.getenv('MAX_UPLOAD_REQUEST_SIZE', 500 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 超过该大小的 .xlsx 文件自动使用流式读取
+STREAMING_FILE_SIZE = int(os.getenv('STREAMING_FILE_SIZE', 20 * 1024 * 1024))
+# 解析Excel文件的进程数，默认使用所有CPU核心
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', os.cpu_count() or 1))
+
+# 同时处理（解析+入库）的文件数上限，以及排队等待处理的文件数上限，队列满时上传返回 429
+MAX_INGEST_IN_FLIGHT = int(os.getenv('MAX_INGEST_IN_FLIGHT', INGEST_WORKERS * 2))
+MAX_INGEST_QUEUE = int(os.getenv('MAX_INGEST_QUEUE', 300))
+
+# 批量插入数据库时每批的行数
+INSERT_BATCH_SIZE = int(os.getenv('INSERT_BATCH_SIZE', 1000))
+
+# 流式读取时缓存的原始商品行数上限（送货单结束且缓存达到该行数时批量转换并释放原始行，
+# 转换出的商品保留到整个文件解析完成）
+STREAMING_BATCH_ROWS = int(os.getenv('STREAMING_BATCH_ROWS', 1000))
+
+
+class KeywordMatcher:
+    """预编译的多关键词匹配器，表头识别、商品结束行识别和列映射共用
+
+    所有关键词编译为一个多选正则，一次扫描即可判断文本中是否含有任一关键词；
+    大多数数据行不含关键词，直接返回，只有命中的少数行再确定具体是哪些关键词。
+    结果与逐个关键词做 in 判断完全一致（包括互相包含的关键词，如 送货单位 与 送货单、单位）。
+    """
+
+    def __init__(self, keywords):
+        self.keywords = tuple(dict.fromkeys(keywords))
+        # 长的关键词在前，同一位置优先匹配较长的关键词
+        self.pattern = re.compile('|'.join(re.escape(keyword) for keyword in
+                                           sorted(self.keywords, key=len, reverse=True)))
+
+    def search(self, text: str) -> bool:
+        """文本中是否含有任一关键词"""
+        return self.pattern.search(text) is not None
+
+    def find_all(self, text: str) -> List[str]:
+        """文本中出现的全部关键词（按定义顺序）"""
+        if self.pattern.search(text) is None:
+            return []
+        return [keyword for keyword in self.keywords if keyword in text]
+
+    def first(self, text: str) -> Optional[str]:
+        """按定义顺序第一个出现在文本中的关键词"""
+        if self.pattern.search(text) is None:
+            return None
+        return next(keyword for keyword in self.keywords if keyword in text)
+
+
+# 送货单关键词
+DELIVERY_NOTE_KEYWORDS = [
+    '送货单', '送货时间', '订货单位', '送货单位',
+    '商品名称', '品名', '名称', '序号', '规格',
+    '订货数量', '数量', '单位', '原始单价', '报价',
+    '折扣率', '执行单价', '结算价', '金额'
+]
+DELIVERY_NOTE_MATCHER = KeywordMatcher(DELIVERY_NOTE_KEYWORDS)
+# 至少包含3个关键词才认为是送货单表头
+DELIVERY_NOTE_HEADER_MIN_KEYWORDS = 3
+
+
+def delivery_note_keyword_count(row_text: str) -> int:
+    """行文本中包含的送货单关键词个数"""
+    return len(DELIVERY_NOTE_MATCHER.find_all(row_text))
+
+
+def build_row_texts(df: pd.DataFrame) -> pd.Series:
+    """按列拼接每行的文本（等价于逐行 ' '.join(非空单元格)），整个工作表只构建一次"""
+    row_texts = pd.Series([''] * len(df), index=df.index, dtype=object)
+    has_text = pd.Series(False, index=df.index)
+
+    for col in range(df.shape[1]):
+        column = df.iloc[:, col]
+        valid = column.notna()
+        if not valid.any():
+            continue
 
-        # 检查是否为制单员行（送货单结束）
-        elif '制单员：' in row_text and current_note is not None:
-            delivery_notes.append({
-                'start_row': start_row,
-                'end_row': i - 1,
-                'info': current_note
-            })
-            current_note = None
-            start_row = -1
-
-    # 添加最后一个送货单
-    if current_note is not None:
-        delivery_notes.append({
-            'start_row': start_row,
-            'end_row': len(df) - 1,
-            'info': current_note
-        })
+        cell_texts = column[valid].map(str)
+        joined = has_text[valid]
+        row_texts[valid] = (row_texts[valid].where(~joined, row_texts[valid] + ' ') + cell_texts).values
+        has_text |= valid
 
-    print(f"总共找到 {len(delivery_notes)} 个送货单")
-    return delivery_notes
+    return row_texts
 
 
-def extract_delivery_info_from_header(row: pd.Series) -> Dict[str, Any]:
-    """从表头行提取送货单信息"""
-    info = {
-        'delivery_date': None,
-        'order_unit': None,
-        'delivery_unit': None
-    }
+# 送货时间行的日期匹配，以及任意单元格中的日期匹配
+DELIVERY_TIME_PATTERN = re.compile(r'送货时间[：:]\s*(\d{4}年\d{1,2}月\d{1,2}日|\d{4}-\d{1,2}-\d{1,2})')
+DATE_PATTERN = re.compile(r'(\d{4}年\d{1,2}月\d{1,2}日|\d{4}-\d{1,2}-\d{1,2})')
 
-    row_text = ' '.join(str(cell) for cell in row.values if pd.notna(cell))
+# 商品数据结束的关键词（合计行、制单员行等）
+PRODUCT_TERMINATORS = ['合计', '总计', '总金额', '小计', '制单员']
+TERMINATOR_MATCHER = KeywordMatcher(PRODUCT_TERMINATORS)
 
-    # 提取订货单位
-    order_match = re.search(r'订货单位[：:]\s*(.+)', row_text)
-    if order_match:
-        info['order_unit'] = order_match.group(1).strip()
+# 商品表头的列名关键词及对应字段，按顺序匹配（单元格同时含多个列名时取靠前的）
+PRODUCT_COLUMN_KEYWORDS = {
+    '序号': 'serial_number',
+    '商品名称': 'product_name',
+    '单位': 'unit',
+    '订货数量': 'quantity',
+    '原始单价': 'supplier_price',
+    '折扣率': 'discount_rate',
+    '执行单价': 'settlement_price',
+    '金额': 'amount'
+}
+PRODUCT_COLUMN_MATCHER = KeywordMatcher(PRODUCT_COLUMN_KEYWORDS)
 
-    # 提取送货单位
-    delivery_match = re.search(r'送货单位[：:]\s*(.+)', row_text)
-    if delivery_match:
-        info['delivery_unit'] = delivery_match.group(1).strip()
+NUMBER_CLEAN_PATTERN = re.compile(r'[^\d.]')
 
-    return info
-def extract_products_from_delivery_note(df: pd.DataFrame, start_row: int, end_row: int) -> List[Dict[str, Any]]:
-    """从送货单中提取商品信息"""
-    products = []
 
-    if start_row < 0 or end_row >= len(df) or start_row > end_row:
-        return products
+def parse_date_string(date_str: str):
+    """把 2025年9月1日 或 2025-9-1 格式的字符串转换为日期，格式错误时抛出 ValueError"""
+    if '年' in date_str:
+        return datetime.strptime(date_str, '%Y年%m月%d日').date()
+    return datetime.strptime(date_str, '%Y-%m-%d').date()
 
-    # 查找列索引
-    header_row = df.iloc[start_row - 1]  # 表头在数据开始的前一行
+
+def map_product_columns(header_values) -> Dict[str, int]:
+    """根据商品表头行确定各字段所在的列"""
     column_mapping = {}
 
-    for j, cell in enumerate(header_row.values):
+    for j, cell in enumerate(header_values):
         cell_str = str(cell).strip() if pd.notna(cell) else ''
 
         # 精确匹配列名
-        if '序号' in cell_str:
-            column_mapping['serial_number'] = j
-        elif '商品名称' in cell_str:
-            column_mapping['product_name'] = j
-        elif '单位' in cell_str:
-            column_mapping['unit'] = j
-        elif '订货数量' in cell_str:
-            column_mapping['quantity'] = j
-        elif '原始单价' in cell_str:
-            column_mapping['supplier_price'] = j
-        elif '折扣率' in cell_str:
-            column_mapping['discount_rate'] = j
-        elif '执行单价' in cell_str:
-            column_mapping['settlement_price'] = j
-        elif '金额' in cell_str:
-            column_mapping['amount'] = j
-
-    print(f"列映射结果: {column_mapping}")
-
-    # 提取商品数据
-    for i in range(start_row, end_row + 1):
-        row = df.iloc[i]
-
-        # 检查是否为空行或合计行
-        if pd.isna(row.iloc[0]) or any(
-                keyword in str(row.iloc[0]) for keyword in ['合计', '总计', '总金额', '小计', '制单员']):
-            break
+        keyword = PRODUCT_COLUMN_MATCHER.first(cell_str)
+        if keyword is not None:
+            column_mapping[PRODUCT_COLUMN_KEYWORDS[keyword]] = j
+
+    return column_mapping
+
+
+# 模板注册表最多记住的表头版式数
+TEMPLATE_REGISTRY_SIZE = int(os.getenv('TEMPLATE_REGISTRY_SIZE', 1000))
+
+
+class TemplateRegistry:
+    """已知送货单模板的列映射缓存
+
+    同一供应商每天发送的送货单版式相同。以商品表头行规整后的单元格及其位置作为指纹，
+    缓存 map_product_columns 的结果，已知版式直接取出列映射；
+    未知版式按原逻辑识别后记录下来（最多 max_templates 个）。
+    """
+
+    def __init__(self, max_templates: int = TEMPLATE_REGISTRY_SIZE):
+        self.max_templates = max_templates
+        self._templates: Dict[Tuple[str, ...], Dict[str, int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(header_values) -> Tuple[str, ...]:
+        """表头指纹：每列去掉首尾空白后的文本（空单元格为空串），去掉末尾的空列"""
+        cells = [str(cell).strip() if pd.notna(cell) else '' for cell in header_values]
+        while cells and not cells[-1]:
+            cells.pop()
+        return tuple(cells)
+
+    def column_mapping(self, header_values) -> Dict[str, int]:
+        key = self.fingerprint(header_values)
+        mapping = self._templates.get(key)
+        if mapping is None:
+            self.misses += 1
+            mapping = map_product_columns(header_values)
+            if len(self._templates) < self.max_templates:
+                self._templates[key] = mapping
+        else:
+            self.hits += 1
+        return dict(mapping)
+
+    def stats(self) -> Dict[str, int]:
+        return {'templates': len(self._templates), 'hits': self.hits, 'misses': self.misses}
+
+
+template_registry = TemplateRegistry()
+
+
+def is_product_terminator(values) -> bool:
+    """检查是否为空行或合计行（商品数据到此结束）"""
+    first_cell = values[0]
+    return pd.isna(first_cell) or TERMINATOR_MATCHER.search(str(first_cell))
+
+
+# 数值字段及映射中缺少该列时的默认值
+NUMERIC_FIELDS = {
+    'quantity': 0,
+    'supplier_price': 0,
+    'discount_rate': 100,
+    'settlement_price': 0,
+    'amount': 0
+}
+
+
+def extract_products_batch(rows: pd.DataFrame, column_mapping: Dict[str, int],
+                           default_serials: pd.Series) -> Tuple[Dict[int, Dict[str, Any]], pd.Series]:
+    """按列批量转换商品行
+
+    rows 为一个或多个（列映射相同的）送货单商品区域的切片，index 为行号；
+    default_serials 为没有序号列时使用的序号。
+    返回 ({行号: 商品}, 错误掩码)，错误掩码为 True 的行表示数值无法转换，不再静默丢弃。
+    """
+    if 'product_name' not in column_mapping:
+        return {}, pd.Series(True, index=rows.index)
+
+    names = rows.iloc[:, column_mapping['product_name']]
+    # 商品名称为空的行不是商品行
+    rows = rows[names.notna()]
+    names = names[names.notna()].map(str).str.strip()
+
+    # 确保商品名称不为空
+    is_product = (names != '') & ~names.str.startswith('序号')
+    rows = rows[is_product]
+    names = names[is_product]
+
+    error_mask = pd.Series(False, index=rows.index)
+    columns = {}
+
+    for field, default in NUMERIC_FIELDS.items():
+        if field in column_mapping:
+            cleaned = rows.iloc[:, column_mapping[field]].astype(str).str.replace(NUMBER_CLEAN_PATTERN, '', regex=True)
+            values = pd.to_numeric(cleaned, errors='coerce').astype(float)
+            error_mask |= values.isna()
+            columns[field] = values
+        else:
+            columns[field] = pd.Series(default, index=rows.index, dtype=object)
+
+    if 'serial_number' in column_mapping:
+        serials = pd.to_numeric(rows.iloc[:, column_mapping['serial_number']], errors='coerce')
+        error_mask |= serials.isna()
+    else:
+        serials = default_serials[rows.index]
+
+    if 'unit' in column_mapping:
+        units = rows.iloc[:, column_mapping['unit']].map(str).str.strip()
+    else:
+        units = pd.Series('', index=rows.index)
+
+    valid = ~error_mask
+    products = dict(zip(rows.index[valid].tolist(), (
+        {
+            'serial_number': int(serial_number),
+            'product_name': product_name,
+            'specification': '',  # 你的送货单中没有规格字段
+            'quantity': quantity,
+            'unit': unit,
+            'supplier_price': supplier_price,
+            'discount_rate': discount_rate,
+            'settlement_price': settlement_price,
+            'amount': amount
+        }
+        for serial_number, product_name, unit, quantity, supplier_price, discount_rate, settlement_price, amount
+        in zip(serials[valid].tolist(), names[valid].tolist(), units[valid].tolist(),
+               *(columns[field][valid].tolist() for field in NUMERIC_FIELDS))
+    )))
+
+    if error_mask.any():
+        log_sampled('failed_rows', "提取商品数据时出错: 第 %s 行数值格式错误", error_mask.index[error_mask].tolist())
+
+    return products, error_mask
 
-        try:
-            # 检查是否还有商品数据
-            if pd.isna(row.iloc[column_mapping['product_name']]):
-                continue
 
-            product = {
-                'serial_number': int(row.iloc[column_mapping[
-                    'serial_number']]) if 'serial_number' in column_mapping else i - start_row + 1,
-                'product_name': str(row.iloc[column_mapping['product_name']]).strip(),
-                'specification': '',  # 你的送货单中没有规格字段
-                'quantity': float(re.sub(r'[^\d.]', '', str(
-                    row.iloc[column_mapping['quantity']]))) if 'quantity' in column_mapping else 0,
-                'unit': str(row.iloc[column_mapping['unit']]).strip() if 'unit' in column_mapping else '',
-                'supplier_price': float(re.sub(r'[^\d.]', '', str(
-                    row.iloc[column_mapping['supplier_price']]))) if 'supplier_price' in column_mapping else 0,
-                'discount_rate': float(re.sub(r'[^\d.]', '', str(row.iloc[column_mapping['discount_rate']]).replace('%',
-                                                                                                                    ''))) if 'discount_rate' in column_mapping else 100,
-                'settlement_price': float(re.sub(r'[^\d.]', '', str(
-                    row.iloc[column_mapping['settlement_price']]))) if 'settlement_price' in column_mapping else 0,
-                'amount': float(
-                    re.sub(r'[^\d.]', '', str(row.iloc[column_mapping['amount']]))) if 'amount' in column_mapping else 0
+class SheetScanner:
+    """单次扫描工作表的状态机
+
+    每行只读取一次，依次产出送货日期、送货单表头、列映射和商品行。
+    pandas 读取的工作表（scan_sheet）和流式读取的工作表（scan_workbook）都通过它识别送货单。
+    商品行先缓存，累计到 batch_rows 行或扫描结束时再按列批量转换。
+    """
+
+    def __init__(self, batch_rows: int = 5000):
+        self.delivery_notes = []
+        self.current_note = None
+        self.delivery_date = None   # 送货时间行中的日期
+        self.fallback_date = None   # 任意单元格中第一个日期
+        self.row_count = 0
+        self.batch_rows = batch_rows
+        # 批量转换商品行的累计耗时（秒）
+        self.extract_seconds = 0.0
+
+        # 等待批量转换的商品行
+        self.pending_notes = []
+        self.pending_rows = []
+        self.pending_index = []
+
+    def feed(self, i: int, values, row_text: Optional[str] = None):
+        """处理第 i 行，values 为该行所有单元格的值"""
+        self.row_count += 1
+        if row_text is None:
+            row_text = ' '.join(str(cell) for cell in values if pd.notna(cell))
+
+        if self.delivery_date is None:
+            self._scan_date(values, row_text)
+
+        if '订货单位：' in row_text:
+            log_sampled('note_header', "找到送货单表头在第 %s 行: %s", i, row_text)
+            self._close_note(i - 1)
+
+            info = {
+                'delivery_date': None,
+                'order_unit': None,
+                'delivery_unit': None
             }
+            order_match = re.search(r'订货单位[：:]\s*(.+)', row_text)
+            if order_match:
+                info['order_unit'] = order_match.group(1).strip()
+            delivery_match = re.search(r'送货单位[：:]\s*(.+)', row_text)
+            if delivery_match:
+                info['delivery_unit'] = delivery_match.group(1).strip()
+
+            self.current_note = {
+                'start_row': i + 2,  # 数据从表头行的下两行开始
+                'end_row': None,
+                'info': info,
+                'products': [],
+                'failed_rows': [],
+                'column_mapping': None,
+                'stopped': False,
+                'row_numbers': []
+            }
+            return
+
+        note = self.current_note
+        if note is None:
+            return
+
+        if '制单员：' in row_text:
+            self._close_note(i - 1)
+            self.current_note = None
+        elif i == note['start_row'] - 1:
+            note['column_mapping'] = template_registry.column_mapping(values)
+            log_sampled('column_mapping', "列映射结果: %s", note['column_mapping'])
+        elif i >= note['start_row'] and not note['stopped']:
+            if is_product_terminator(values):
+                note['stopped'] = True
+                return
+            note['row_numbers'].append(i)
+            self.pending_rows.append(values)
+            self.pending_index.append(i)
+
+    def _scan_date(self, values, row_text: str):
+        date_match = DELIVERY_TIME_PATTERN.search(row_text)
+        if date_match:
+            try:
+                self.delivery_date = parse_date_string(date_match.group(1))
+                logger.debug(f"找到送货日期: {self.delivery_date}")
+                return
+            except ValueError as e:
+                logger.warning(f"日期格式转换失败: {date_match.group(1)}, 错误: {e}")
+
+        # 备用方式：记录第一个包含日期的单元格
+        if self.fallback_date is None and DATE_PATTERN.search(row_text):
+            for cell in values:
+                if pd.notna(cell):
+                    date_match = DATE_PATTERN.search(str(cell))
+                    if date_match:
+                        try:
+                            self.fallback_date = parse_date_string(date_match.group(1))
+                            break
+                        except ValueError:
+                            continue
+
+    def _close_note(self, end_row: int):
+        note = self.current_note
+        if note is None:
+            return
+
+        note['end_row'] = end_row
+        self.delivery_notes.append(note)
+        self.pending_notes.append(note)
+        if len(self.pending_rows) >= self.batch_rows:
+            self._flush()
+
+    def _flush(self):
+        """把缓存的商品行按列映射分组，每组一次性按列转换"""
+        started = time.perf_counter()
+        if self.pending_rows:
+            rows = pd.DataFrame(self.pending_rows, index=self.pending_index)
+
+            groups = {}
+            for note in self.pending_notes:
+                key = tuple(sorted((note['column_mapping'] or {}).items()))
+                groups.setdefault(key, []).append(note)
+
+            for key, notes in groups.items():
+                row_numbers = [i for note in notes for i in note['row_numbers']]
+                if not row_numbers:
+                    continue
+                default_serials = pd.Series([i - note['start_row'] + 1 for note in notes for i in note['row_numbers']],
+                                            index=row_numbers)
+                products, error_mask = extract_products_batch(rows.loc[row_numbers], dict(key), default_serials)
+                failed = set(error_mask.index[error_mask].tolist())
+                for note in notes:
+                    note['products'] = [products[i] for i in note['row_numbers'] if i in products]
+                    note['failed_rows'] = [i for i in note['row_numbers'] if i in failed]
+
+        self.pending_notes = []
+        self.pending_rows = []
+        self.pending_index = []
+        self.extract_seconds += time.perf_counter() - started
+
+    def finish(self):
+        """结束扫描，返回 (送货日期, 送货单列表)"""
+        self._close_note(self.row_count - 1)
+        self.current_note = None
+        self._flush()
+
+        delivery_date = self.delivery_date
+        if delivery_date is None and self.fallback_date is not None:
+            delivery_date = self.fallback_date
+            logger.debug(f"通过其他方式找到送货日期: {delivery_date}")
+        if delivery_date is None:
+            delivery_date = datetime.now().date()
+            logger.warning(f"未找到送货日期，使用当前日期: {delivery_date}")
+
+        for note in self.delivery_notes:
+            note['info']['delivery_date'] = delivery_date
+            del note['column_mapping'], note['stopped'], note['row_numbers']
+
+        logger.debug(f"总共找到 {len(self.delivery_notes)} 个送货单")
+        return delivery_date, self.delivery_notes
+
+
+def add_stage_seconds(timings: Optional[Dict[str, float]], stage: str, seconds: float):
+    """累加某个入库阶段的耗时"""
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def scan_sheet(df: pd.DataFrame, timings: Optional[Dict[str, float]] = None):
+    """用 SheetScanner 单次扫描一个工作表，返回 (送货日期, 送货单列表)
+
+    timings 不为 None 时累加 note_detection 和 extraction 两个阶段的耗时。
+    """
+    started = time.perf_counter()
+    scanner = SheetScanner()
+    row_texts = build_row_texts(df)
+    for i, values, row_text in zip(df.index, df.to_numpy(dtype=object), row_texts):
+        scanner.feed(i, values, row_text)
+    result = scanner.finish()
+    add_stage_seconds(timings, 'note_detection', time.perf_counter() - started - scanner.extract_seconds)
+    add_stage_seconds(timings, 'extraction', scanner.extract_seconds)
+    return result
+
+
+def iter_sheet_rows(worksheet):
+    """流式读取工作表的行（只读模式），行号与 pd.read_excel 的结果一致
 
-            # 确保商品名称不为空
-            if product['product_name'] and not product['product_name'].startswith('序号'):
-                products.append(product)
-                print(f"提取到商品: {product['product_name']}")
-        except (ValueError, IndexError, KeyError) as e:
-            print(f"提取商品数据时出错: {e}")
+    第一行作为列名跳过，末尾的空行不输出。
+    """
+    rows = worksheet.iter_rows(values_only=True)
+    next(rows, None)
+
+    blank_start = None
+    blank_width = 0
+    for i, values in enumerate(rows):
+        if all(cell is None for cell in values):
+            if blank_start is None:
+                blank_start = i
+            blank_width = len(values)
             continue
 
-    return products
+        # 中间的空行原样输出，末尾的空行丢弃
+        if blank_start is not None:
+            for j in range(blank_start, i):
+                yield j, (None,) * blank_width
+            blank_start = None
+        yield i, values
 
 
-def save_to_database(file_name: str, delivery_info: Dict[str, Any], products: List[Dict[str, Any]]) -> bool:
-    """将数据保存到MySQL数据库"""
-    db = SessionLocal()
+def should_stream(file_path: str, streaming: Optional[bool] = None) -> bool:
+    """是否使用流式读取：None 时按文件大小自动选择，.xls 文件不支持流式读取"""
+    if not file_path.endswith('.xlsx'):
+        return False
+    if streaming is None:
+        return os.path.getsize(file_path) >= STREAMING_FILE_SIZE
+    return streaming
+
+
+# Excel 读取引擎：名称 -> (pandas 的 engine 参数, 需要安装的模块, 支持的扩展名)
+# openpyxl-readonly 不经过 pandas，逐行流式读取
+READER_ENGINES = {
+    'calamine': ('calamine', 'python_calamine', ('.xlsx', '.xls')),
+    'openpyxl': ('openpyxl', 'openpyxl', ('.xlsx',)),
+    'openpyxl-readonly': (None, 'openpyxl', ('.xlsx',)),
+    'xlrd': ('xlrd', 'xlrd', ('.xls',)),
+}
+# 自动选择时的优先级（按 benchmark.py readers 测得的读取速度）：
+# calamine 基于 Rust，比 openpyxl 快数倍；openpyxl 逐行读取比经过 pandas 构建 DataFrame 快约 20%
+READER_ENGINE_ORDER = ('calamine', 'openpyxl-readonly', 'openpyxl', 'xlrd')
+# 指定读取引擎，auto 为按文件类型和大小自动选择
+EXCEL_READER_ENGINE = os.getenv('EXCEL_READER_ENGINE', 'auto')
+
+
+@functools.lru_cache(maxsize=None)
+def _module_available(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def available_reader_engines(file_path: Optional[str] = None) -> List[str]:
+    """已安装的读取引擎，指定 file_path 时只返回支持该文件类型的引擎"""
+    extension = os.path.splitext(file_path)[1].lower() if file_path else None
+    return [name for name, (_, module, extensions) in READER_ENGINES.items()
+            if _module_available(module) and (extension is None or extension in extensions)]
+
+
+def select_reader_engine(file_path: str, streaming: Optional[bool] = None, engine: Optional[str] = None) -> str:
+    """选择读取引擎：指定了 engine（或 EXCEL_READER_ENGINE）时使用指定的引擎，
+    否则需要流式读取（见 should_stream）时用 openpyxl-readonly，
+    其余按 READER_ENGINE_ORDER 选择可用的最快引擎，streaming 为 False 时不选流式引擎
+    """
+    engine = engine or EXCEL_READER_ENGINE
+    available = available_reader_engines(file_path)
+    if engine != 'auto':
+        if engine not in READER_ENGINES:
+            raise ValueError(f"未知的读取引擎: {engine}")
+        if engine not in available:
+            raise ValueError(f"读取引擎 {engine} 未安装或不支持 {os.path.basename(file_path)}")
+        return engine
+
+    if should_stream(file_path, streaming):
+        return 'openpyxl-readonly'
+    for name in READER_ENGINE_ORDER:
+        if name in available and not (streaming is False and name == 'openpyxl-readonly'):
+            return name
+    raise ValueError(f"没有可读取 {os.path.basename(file_path)} 的引擎，.xls 文件需要安装 xlrd 或 python-calamine")
+
+
+# 判断工作表是否为送货单时读取的行数，0 表示不预筛选（全部读取）
+SHEET_PEEK_ROWS = int(os.getenv('SHEET_PEEK_ROWS', 50))
+
+# 平均每行的读取耗时（秒），用于估算跳过工作表节省的时间
+_row_read_seconds = None
+
+
+def classify_sheet_head(rows) -> Tuple[bool, int]:
+    """根据工作表开头若干行判断是否可能包含送货单，返回 (是否读取, 最高关键词得分)
+
+    任一行包含至少 DELIVERY_NOTE_HEADER_MIN_KEYWORDS 个送货单关键词，或包含送货单表头的“订货单位”时读取。
+    """
+    best_score = 0
+    qualifies = False
+    for values in rows:
+        row_text = ' '.join(str(cell) for cell in values if pd.notna(cell))
+        score = delivery_note_keyword_count(row_text)
+        best_score = max(best_score, score)
+        if score >= DELIVERY_NOTE_HEADER_MIN_KEYWORDS or '订货单位' in row_text:
+            qualifies = True
+    return qualifies, best_score
+
+
+def sheet_row_count(book, sheet_name: str) -> Optional[int]:
+    """从工作簿元数据读取工作表行数（不读取数据），无法获得时返回 None"""
     try:
-        print(f"准备保存 {len(products)} 个商品到数据库")
-        print(f"送货信息: {delivery_info}")
-
-        # 检查送货日期是否为空
-        if delivery_info.get('delivery_date') is None:
-            print("警告: delivery_date 为 None，使用当前日期")
-            delivery_info['delivery_date'] = datetime.now().date()
-
-        for i, product in enumerate(products):
-            print(f"处理第 {i + 1} 个商品: {product['product_name']}")
-
-            # 处理折扣率百分比转换
-            discount_rate = product['discount_rate']
-            if discount_rate > 1:  # 如果是百分比形式（如90），转换为小数（0.9）
-                discount_rate = discount_rate / 100
-                print(f"折扣率转换: {product['discount_rate']} -> {discount_rate}")
-
-            delivery = HongshanShixiaoDelivery(
-                file_name=file_name,
-                delivery_date=delivery_info['delivery_date'],
-                ordering_unit=delivery_info.get('order_unit', '未知'),
-                delivery_unit=delivery_info.get('delivery_unit', '未知'),
-                serial_number=product['serial_number'],
-                product_name=product['product_name'],
-                specification=product['specification'],
-                quantity=product['quantity'],
-                unit=product['unit'],
-                supplier_price=product['supplier_price'],
-                discount_rate=discount_rate,
-                settlement_price=product['settlement_price'],
-                amount=product['amount']
+        if hasattr(book, 'worksheets'):  # openpyxl
+            return book[sheet_name].max_row
+        if hasattr(book, 'sheet_by_name'):  # xlrd
+            return book.sheet_by_name(sheet_name).nrows
+        return book.get_sheet_by_name(sheet_name).total_height  # python-calamine
+    except Exception:
+        return None
+
+
+def _finish_sheet_reports(sheet_reports: List[Dict[str, Any]]):
+    """用已读取工作表的每行耗时估算跳过的工作表节省的时间"""
+    global _row_read_seconds
+    read_rows = sum(report['rows'] or 0 for report in sheet_reports if not report['skipped'])
+    read_seconds = sum(report['read_seconds'] for report in sheet_reports if not report['skipped'])
+    if read_rows:
+        _row_read_seconds = read_seconds / read_rows
+    for report in sheet_reports:
+        if report['skipped'] and report['rows'] is not None and _row_read_seconds is not None:
+            report['saved_seconds'] = round(max(0.0, report['rows'] * _row_read_seconds - report['peek_seconds']), 4)
+        report['peek_seconds'] = round(report['peek_seconds'], 4)
+        report['read_seconds'] = round(report['read_seconds'], 4)
+
+
+def scan_workbook(file_path: str, engine: str = 'openpyxl', timings: Optional[Dict[str, float]] = None,
+                  sheet_reports: Optional[List[Dict[str, Any]]] = None):
+    """逐个工作表扫描工作簿，产出 (工作表名, 送货日期, 送货单列表)
+
+    engine 为 READER_ENGINES 中的读取引擎。openpyxl-readonly 为流式模式：
+    用 openpyxl 只读模式逐行读取，不构建 DataFrame，
+    缓存的原始商品行达到 STREAMING_BATCH_ROWS 后在送货单结束时立即转换并释放。
+    原始行和工作表内容不随工作簿大小增长，但提取出的商品（每行一个字典）会保留到整个文件解析完成，
+    内存占用随工作簿的商品行数线性增长。
+    其余引擎通过 pandas 读取整个工作表。
+
+    每个工作表先只读开头 SHEET_PEEK_ROWS 行，classify_sheet_head 判断不是送货单时跳过（不产出）。
+    sheet_reports 不为 None 时为每个工作表追加一条记录：是否跳过、关键词得分、预读耗时和估算节省的时间。
+    timings 不为 None 时累加 workbook_open、sheet_peek、sheet_read、note_detection、extraction 各阶段的耗时。
+    """
+    reports = [] if sheet_reports is None else sheet_reports
+    started = time.perf_counter()
+    if engine != 'openpyxl-readonly':
+        excel_file = pd.ExcelFile(file_path, engine=READER_ENGINES[engine][0])
+        add_stage_seconds(timings, 'workbook_open', time.perf_counter() - started)
+        for sheet_name in excel_file.sheet_names:
+            report = {'sheet_name': sheet_name, 'skipped': False, 'score': None, 'rows': None,
+                      'peek_seconds': 0.0, 'read_seconds': 0.0, 'saved_seconds': None}
+            reports.append(report)
+            if SHEET_PEEK_ROWS > 0:
+                # pandas 读取时会重置 openpyxl 记录的工作表尺寸，先取行数
+                row_count = sheet_row_count(excel_file.book, sheet_name)
+                started = time.perf_counter()
+                head = pd.read_excel(excel_file, sheet_name=sheet_name, header=None, nrows=SHEET_PEEK_ROWS)
+                qualifies, report['score'] = classify_sheet_head(head.to_numpy(dtype=object))
+                report['peek_seconds'] = time.perf_counter() - started
+                add_stage_seconds(timings, 'sheet_peek', report['peek_seconds'])
+                if not qualifies and len(head) < SHEET_PEEK_ROWS:
+                    # 整个工作表都已读过，不需要估算
+                    report.update(skipped=True, rows=len(head), saved_seconds=0.0)
+                    continue
+                if not qualifies:
+                    report.update(skipped=True, rows=row_count)
+                    continue
+
+            started = time.perf_counter()
+            df = pd.read_excel(excel_file, sheet_name=sheet_name)
+            report['read_seconds'] = time.perf_counter() - started
+            report['rows'] = len(df) + 1
+            add_stage_seconds(timings, 'sheet_read', report['read_seconds'])
+            yield (sheet_name,) + scan_sheet(df, timings)
+        _finish_sheet_reports(reports)
+        return
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    add_stage_seconds(timings, 'workbook_open', time.perf_counter() - started)
+    try:
+        for worksheet in workbook.worksheets:
+            report = {'sheet_name': worksheet.title, 'skipped': False, 'score': None, 'rows': None,
+                      'peek_seconds': 0.0, 'read_seconds': 0.0, 'saved_seconds': None}
+            reports.append(report)
+            if SHEET_PEEK_ROWS > 0:
+                started = time.perf_counter()
+                head = list(worksheet.iter_rows(max_row=SHEET_PEEK_ROWS, values_only=True))
+                qualifies, report['score'] = classify_sheet_head(head)
+                report['peek_seconds'] = time.perf_counter() - started
+                add_stage_seconds(timings, 'sheet_peek', report['peek_seconds'])
+                if not qualifies and len(head) < SHEET_PEEK_ROWS:
+                    report.update(skipped=True, rows=len(head), saved_seconds=0.0)
+                    continue
+                if not qualifies:
+                    report.update(skipped=True, rows=sheet_row_count(workbook, worksheet.title))
+                    continue
+
+            # 读取和扫描交替进行：分别累计扫描耗时，其余为读取耗时
+            sheet_started = time.perf_counter()
+            scan_seconds = 0.0
+            scanner = SheetScanner(batch_rows=STREAMING_BATCH_ROWS)
+            for i, values in iter_sheet_rows(worksheet):
+                started = time.perf_counter()
+                scanner.feed(i, values)
+                scan_seconds += time.perf_counter() - started
+            started = time.perf_counter()
+            sheet_result = scanner.finish()
+            finished = time.perf_counter()
+            scan_seconds += finished - started
+            report['read_seconds'] = finished - sheet_started - scan_seconds
+            report['rows'] = scanner.row_count + 1
+            add_stage_seconds(timings, 'sheet_read', report['read_seconds'])
+            add_stage_seconds(timings, 'note_detection', scan_seconds - scanner.extract_seconds)
+            add_stage_seconds(timings, 'extraction', scanner.extract_seconds)
+            yield (worksheet.title,) + sheet_result
+        _finish_sheet_reports(reports)
+    finally:
+        workbook.close()
+
+
+def build_delivery_rows(file_name: str, delivery_info: Dict[str, Any],
+                        products: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """把一个送货单的商品转换为 hongshan_shixiao_delivery 表的行"""
+    # 检查送货日期是否为空
+    if delivery_info.get('delivery_date') is None:
+        logger.warning("delivery_date 为 None，使用当前日期")
+        delivery_info['delivery_date'] = datetime.now().date()
+
+    rows = []
+    for product in products:
+        # 处理折扣率百分比转换
+        discount_rate = product['discount_rate']
+        if discount_rate > 1:  # 如果是百分比形式（如90），转换为小数（0.9）
+            discount_rate = discount_rate / 100
+
+        rows.append({
+            'file_name': file_name,
+            'delivery_date': delivery_info['delivery_date'],
+            'ordering_unit': delivery_info.get('order_unit') or '未知',
+            'delivery_unit': delivery_info.get('delivery_unit') or '未知',
+            'serial_number': product['serial_number'],
+            'product_name': product['product_name'],
+            'specification': product['specification'],
+            'quantity': product['quantity'],
+            'unit': product['unit'],
+            'supplier_price': product['supplier_price'],
+            'discount_rate': discount_rate,
+            'settlement_price': product['settlement_price'],
+            'amount': product['amount']
+        })
+    return rows
+
+
+def insert_delivery_rows(conn, rows: List[Dict[str, Any]], batch_size: int = None):
+    """按批次批量插入（多行 VALUES / executemany），在调用方的事务中执行"""
+    batch_size = batch_size or INSERT_BATCH_SIZE
+    statement = insert(HongshanShixiaoDelivery.__table__)
+    for start in range(0, len(rows), batch_size):
+        conn.execute(statement, rows[start:start + batch_size])
+
+
+def round_price(value) -> Decimal:
+    """把价格四舍五入到两位小数（与数据库 Numeric(10, 2) 一致）"""
+    return Decimal(str(value)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+def _increment_upsert(conn, table, rows: List[Dict[str, Any]], key_columns: List[str], increment_columns: List[str],
+                      min_columns: Tuple[str, ...] = (), max_columns: Tuple[str, ...] = (),
+                      replace_columns: Tuple[str, ...] = ()):
+    """插入汇总行，主键已存在时把 increment_columns 累加上去，min/max_columns 取较小/较大值，
+    replace_columns 直接使用新值
+
+    使用 MySQL / SQLite 各自的 upsert 语法。
+    """
+    if conn.dialect.name == 'mysql':
+        statement = mysql_insert(table)
+        new_values = statement.inserted
+        least, greatest = func.least, func.greatest
+    else:
+        statement = sqlite_insert(table)
+        new_values = statement.excluded
+        # SQLite 的多参数 min()/max() 是标量函数
+        least, greatest = func.min, func.max
+
+    values = {name: table.c[name] + new_values[name] for name in increment_columns}
+    values.update({name: func.coalesce(least(table.c[name], new_values[name]), new_values[name])
+                   for name in min_columns})
+    values.update({name: func.coalesce(greatest(table.c[name], new_values[name]), new_values[name])
+                   for name in max_columns})
+    values.update({name: new_values[name] for name in replace_columns})
+
+    if conn.dialect.name == 'mysql':
+        statement = statement.on_duplicate_key_update(values)
+    else:
+        statement = statement.on_conflict_do_update(index_elements=key_columns, set_=values)
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        conn.execute(statement, rows[start:start + INSERT_BATCH_SIZE])
+
+
+def update_price_summary(conn, rows: List[Dict[str, Any]]):
+    """在入库的同一事务中增量更新价格汇总表"""
+    price_counts = Counter(
+        (row['delivery_date'], row['product_name'], round_price(row['settlement_price']))
+        for row in rows
+    )
+    key_counts = Counter()
+    key_prices = {}
+    for (delivery_date, product_name, price), count in price_counts.items():
+        key_counts[(delivery_date, product_name)] += count
+        key_prices.setdefault((delivery_date, product_name), []).append(price)
+    keys = sorted(key_counts)
+    if not keys:
+        return
+
+    # 先创建或累加每个商品的汇总行，同时锁住这些行，
+    # 并发入库同一天同一商品时在这里排队，保证不同结算价个数准确
+    _increment_upsert(conn, PriceSummary.__table__, [
+        {'delivery_date': delivery_date, 'product_name': product_name,
+         'price_count': 0, 'record_count': key_counts[(delivery_date, product_name)],
+         'min_price': min(key_prices[(delivery_date, product_name)]),
+         'max_price': max(key_prices[(delivery_date, product_name)])}
+        for delivery_date, product_name in keys
+    ], ['delivery_date', 'product_name'], ['record_count'], min_columns=('min_price',), max_columns=('max_price',))
+
+    price_table = PriceSummaryPrice.__table__
+    existing = set()
+    for start in range(0, len(keys), INSERT_BATCH_SIZE):
+        batch = keys[start:start + INSERT_BATCH_SIZE]
+        existing.update(
+            (row.delivery_date, row.product_name, row.settlement_price)
+            for row in conn.execute(
+                select(price_table.c.delivery_date, price_table.c.product_name, price_table.c.settlement_price)
+                .where(tuple_(price_table.c.delivery_date, price_table.c.product_name).in_(batch))
+                .with_for_update()
             )
-            db.add(delivery)
-            print(f"已添加商品: {product['product_name']}")
+        )
+
+    # 已有的结算价累加记录数，新的结算价插入并增加不同结算价个数
+    price_rows = [
+        {'delivery_date': delivery_date, 'product_name': product_name,
+         'settlement_price': price, 'record_count': count}
+        for (delivery_date, product_name, price), count in price_counts.items()
+    ]
+    _increment_upsert(conn, price_table, price_rows,
+                      ['delivery_date', 'product_name', 'settlement_price'], ['record_count'])
+
+    new_prices = Counter(
+        (delivery_date, product_name)
+        for (delivery_date, product_name, price) in price_counts
+        if (delivery_date, product_name, price) not in existing
+    )
+    if new_prices:
+        summary_table = PriceSummary.__table__
+        conn.execute(
+            update(summary_table)
+            .where(summary_table.c.delivery_date == bindparam('key_date'),
+                   summary_table.c.product_name == bindparam('key_product'))
+            .values(price_count=summary_table.c.price_count + bindparam('new_prices')),
+            [{'key_date': delivery_date, 'key_product': product_name, 'new_prices': count}
+             for (delivery_date, product_name), count in new_prices.items()]
+        )
+
+
+def rebuild_price_summary(bind=None):
+    """根据 hongshan_shixiao_delivery 全量重建价格汇总表（用于回填或修复）"""
+    table = HongshanShixiaoDelivery.__table__
+    price_table = PriceSummaryPrice.__table__
+    summary_table = PriceSummary.__table__
+
+    def rebuild(conn):
+        conn.execute(delete(summary_table))
+        conn.execute(delete(price_table))
+        conn.execute(insert(price_table).from_select(
+            ['delivery_date', 'product_name', 'settlement_price', 'record_count'],
+            select(table.c.delivery_date, table.c.product_name, table.c.settlement_price, func.count())
+            .group_by(table.c.delivery_date, table.c.product_name, table.c.settlement_price)
+        ))
+        conn.execute(insert(summary_table).from_select(
+            ['delivery_date', 'product_name', 'price_count', 'record_count', 'min_price', 'max_price'],
+            select(price_table.c.delivery_date, price_table.c.product_name, func.count(),
+                   func.sum(price_table.c.record_count), func.min(price_table.c.settlement_price),
+                   func.max(price_table.c.settlement_price))
+            .group_by(price_table.c.delivery_date, price_table.c.product_name)
+        ))
+
+    bind = bind or get_engine()
+    if isinstance(bind, Connection):
+        rebuild(bind)
+    else:
+        with bind.begin() as conn:
+            rebuild(conn)
+
+
+def update_price_rollups(conn, rows: List[Dict[str, Any]]):
+    """在入库的同一事务中增量更新每日价格汇总表"""
+    rollups = {}
+    ingested_time = datetime.now().replace(microsecond=0)
+    for row in rows:
+        key = (row['product_name'], row['delivery_date'], row['ordering_unit'], row['delivery_unit'])
+        price = round_price(row['settlement_price'])
+        rollup = rollups.get(key)
+        if rollup is None:
+            rollups[key] = {
+                'product_name': key[0], 'delivery_date': key[1], 'ordering_unit': key[2], 'delivery_unit': key[3],
+                'record_count': 1, 'price_sum': price, 'min_price': price, 'max_price': price,
+                'latest_price': price, 'last_ingested': ingested_time
+            }
+        else:
+            rollup['record_count'] += 1
+            rollup['price_sum'] += price
+            rollup['min_price'] = min(rollup['min_price'], price)
+            rollup['max_price'] = max(rollup['max_price'], price)
+            rollup['latest_price'] = price
+
+    # 按主键顺序写入，减少并发入库时的死锁
+    _increment_upsert(conn, DailyPriceRollup.__table__, [rollups[key] for key in sorted(rollups)],
+                      ['product_name', 'delivery_date', 'ordering_unit', 'delivery_unit'],
+                      ['record_count', 'price_sum'], min_columns=('min_price',), max_columns=('max_price',),
+                      replace_columns=('latest_price', 'last_ingested'))
+
+
+def rebuild_price_rollups(bind=None):
+    """根据 hongshan_shixiao_delivery 全量重建每日价格汇总表（用于回填或修复）"""
+    table = HongshanShixiaoDelivery.__table__
+    rollup_table = DailyPriceRollup.__table__
+    group_columns = [table.c.product_name, table.c.delivery_date, table.c.ordering_unit, table.c.delivery_unit]
+
+    # 每组最后入库（id 最大）的记录的结算价
+    latest = aliased(table)
+    latest_price = (
+        select(latest.c.settlement_price)
+        .where(*(latest.c[column.name] == column for column in group_columns))
+        .order_by(latest.c.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+    def rebuild(conn):
+        conn.execute(delete(rollup_table))
+        conn.execute(insert(rollup_table).from_select(
+            ['product_name', 'delivery_date', 'ordering_unit', 'delivery_unit', 'record_count', 'price_sum',
+             'min_price', 'max_price', 'latest_price', 'last_ingested'],
+            select(*group_columns, func.count(), func.sum(table.c.settlement_price),
+                   func.min(table.c.settlement_price), func.max(table.c.settlement_price),
+                   latest_price, func.max(table.c.created_time))
+            .group_by(*group_columns)
+        ))
+
+    bind = bind or get_engine()
+    if isinstance(bind, Connection):
+        rebuild(bind)
+    else:
+        with bind.begin() as conn:
+            rebuild(conn)
+
+
+class DuplicateContentError(Exception):
+    """同样内容（SHA-256）已经入库，例如同时处理了两个内容相同的文件"""
+
+
+def save_file_to_database(file_name: str, delivery_notes: List[Dict[str, Any]],
+                          sha256: Optional[str] = None):
+    """在一个事务中把一个文件的所有送货单批量保存到数据库，失败时整个文件回滚并抛出异常
+
+    指定 sha256 时在同一事务中记录该内容已入库，之后同样内容的上传会被跳过；
+    该内容已入库时抛出 DuplicateContentError，不写入任何记录。
+    """
+    rows = []
+    for note in delivery_notes:
+        rows.extend(build_delivery_rows(file_name, note['info'], note['products']))
+
+    started = time.perf_counter()
+    with get_engine().begin() as conn:
+        if sha256 is not None:
+            try:
+                conn.execute(insert(IngestedContent.__table__).values(sha256=sha256, file_name=file_name,
+                                                                      rows=len(rows)))
+            except IntegrityError as e:
+                raise DuplicateContentError(sha256) from e
+        insert_delivery_rows(conn, rows)
+        update_price_summary(conn, rows)
+        update_price_rollups(conn, rows)
+    elapsed = time.perf_counter() - started
+    logger.info(f"成功保存 {len(rows)} 个商品到数据库，耗时 {elapsed:.3f} 秒")
+
 
-        db.commit()
-        print("数据库提交成功")
+def save_to_database(file_name: str, delivery_info: Dict[str, Any], products: List[Dict[str, Any]]) -> bool:
+    """将一个送货单的数据保存到MySQL数据库"""
+    try:
+        save_file_to_database(file_name, [{'info': delivery_info, 'products': products}])
         return True
     except Exception as e:
-        db.rollback()
-        print(f"数据库保存失败: {e}")
-        import traceback
-        traceback.print_exc()  # 打印完整的错误堆栈
+        logger.exception(f"数据库保存失败: {e}")
         return False
-    finally:
-        db.close()
 
-def process_excel_file(file_path: str) -> Dict[str, Any]:
-    """处理单个Excel文件"""
+
+# 解析结果的列式缓存（Parquet，需要安装 pyarrow）：按文件内容的 SHA-256 和解析器版本保存提取出的送货单和商品，
+# 再次解析同样内容的文件时直接读取缓存；数据库恢复后可用 replay_parsed_cache 从缓存重建记录，不需要重新解析 Excel
+PARSED_CACHE = os.getenv('PARSED_CACHE', '1').lower() not in ('0', 'false', 'no')
+PARSED_CACHE_DIR = os.getenv('PARSED_CACHE_DIR', os.path.join(UPLOAD_DIR, 'parsed'))
+# 解析器版本：修改提取规则后加 1，旧版本的缓存不再使用，重新解析时写入新版本的缓存
+PARSER_VERSION = 1
+
+# 缓存每行一个商品，note 为送货单在文件中的序号，送货单信息在每行重复（Parquet 按列压缩）
+PARSED_NOTE_COLUMNS = ('delivery_date', 'order_unit', 'delivery_unit')
+PARSED_PRODUCT_COLUMNS = ('serial_number', 'product_name', 'specification', 'quantity', 'unit',
+                          'supplier_price', 'discount_rate', 'settlement_price', 'amount')
+
+
+def parsed_cache_enabled() -> bool:
+    return PARSED_CACHE and _module_available('pyarrow')
+
+
+def parsed_cache_path(sha256: str) -> str:
+    return os.path.join(PARSED_CACHE_DIR, f'{sha256}.v{PARSER_VERSION}.parquet')
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parsed_cache_schema():
+    return pa.schema([
+        ('note', pa.int32()),
+        ('delivery_date', pa.date32()),
+        ('order_unit', pa.string()),
+        ('delivery_unit', pa.string()),
+        ('serial_number', pa.int64()),
+        ('product_name', pa.string()),
+        ('specification', pa.string()),
+        ('quantity', pa.float64()),
+        ('unit', pa.string()),
+        ('supplier_price', pa.float64()),
+        ('discount_rate', pa.float64()),
+        ('settlement_price', pa.float64()),
+        ('amount', pa.float64()),
+    ])
+
+
+def write_parsed_cache(sha256: str, result: Dict[str, Any]) -> str:
+    """把解析结果写入列式缓存（先写临时文件再原子重命名），返回缓存路径"""
+    columns = {name: [] for name in ('note',) + PARSED_NOTE_COLUMNS + PARSED_PRODUCT_COLUMNS}
+    for index, note in enumerate(result['delivery_notes']):
+        for product in note['products']:
+            columns['note'].append(index)
+            for name in PARSED_NOTE_COLUMNS:
+                columns[name].append(note['info'].get(name))
+            for name in PARSED_PRODUCT_COLUMNS:
+                columns[name].append(product[name])
+
+    # 文件名、读取引擎和每个送货单的失败行放在文件元数据中
+    metadata = {
+        'parser_version': str(PARSER_VERSION),
+        'file_name': result['file_name'],
+        'engine': result['engine'] or '',
+        'failed_rows': json.dumps([[int(row) for row in note['failed_rows']] for note in result['delivery_notes']])
+    }
+    table = pa.table(columns, schema=_parsed_cache_schema().with_metadata(metadata))
+
+    path = parsed_cache_path(sha256)
+    os.makedirs(PARSED_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=PARSED_CACHE_DIR, prefix='.parsed-', suffix='.part')
+    os.close(fd)
+    try:
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+
+def read_parsed_cache(sha256: str) -> Optional[Dict[str, Any]]:
+    """读取列式缓存，返回 file_name、engine 和 delivery_notes（与 parse_excel_file 的结构相同）；没有缓存时返回 None"""
+    path = parsed_cache_path(sha256)
+    if not os.path.exists(path):
+        return None
+
+    table = pq.read_table(path)
+    metadata = {key.decode(): value.decode() for key, value in table.schema.metadata.items()}
+    notes = [{'info': None, 'products': [], 'failed_rows': failed_rows}
+             for failed_rows in json.loads(metadata['failed_rows'])]
+
+    columns = table.to_pydict()
+    note_columns = [columns[name] for name in PARSED_NOTE_COLUMNS]
+    product_columns = [columns[name] for name in PARSED_PRODUCT_COLUMNS]
+    for index, note_values, product_values in zip(columns['note'], zip(*note_columns), zip(*product_columns)):
+        note = notes[index]
+        if note['info'] is None:
+            note['info'] = dict(zip(PARSED_NOTE_COLUMNS, note_values))
+        note['products'].append(dict(zip(PARSED_PRODUCT_COLUMNS, product_values)))
+
+    return {'file_name': metadata['file_name'], 'engine': metadata['engine'] or None, 'delivery_notes': notes}
+
+
+def parse_excel_file(file_path: str, streaming: Optional[bool] = None, engine: Optional[str] = None,
+                     file_name: Optional[str] = None, sha256: Optional[str] = None) -> Dict[str, Any]:
+    """解析单个Excel文件（不写数据库）
+
+    streaming 为 None 时按文件大小自动选择是否流式读取，engine 为 None 时按 select_reader_engine 选择读取引擎。
+    file_name 为入库时使用的文件名，默认为 file_path 的文件名。
+    启用列式缓存时，同样内容（sha256，未指定时计算文件的 SHA-256）和解析器版本的结果直接从缓存读取，
+    解析成功后写入缓存。
+    """
+    if parsed_cache_enabled():
+        started = time.perf_counter()
+        try:
+            sha256 = sha256 or file_sha256(file_path)
+            cached = read_parsed_cache(sha256)
+        except Exception as e:
+            logger.warning(f"读取解析缓存失败，重新解析 {os.path.basename(file_path)}: {e}")
+            cached = None
+        if cached is not None:
+            return {
+                'file_name': file_name or os.path.basename(file_path),
+                'delivery_notes': cached['delivery_notes'],
+                'saved_to_db': False,
+                'engine': cached['engine'],
+                'streaming': False,
+                'parsed_cache': 'hit',
+                'timings': {'parsed_cache': time.perf_counter() - started},
+                'template_hits': 0,
+                'template_misses': 0,
+                'sheets': [],
+                'error': None
+            }
+        cache_seconds = time.perf_counter() - started
+
     result = {
-        'file_name': os.path.basename(file_path),
+        'file_name': file_name or os.path.basename(file_path),
         'delivery_notes': [],
         'saved_to_db': False,
+        'engine': None,
+        'streaming': False,
+        'timings': {},
+        'template_hits': 0,
+        'template_misses': 0,
+        'sheets': [],
         'error': None
     }
+    hits, misses = template_registry.hits, template_registry.misses
 
     try:
-        excel_file = pd.ExcelFile(file_path)
+        result['engine'] = select_reader_engine(file_path, streaming, engine)
+        result['streaming'] = result['engine'] == 'openpyxl-readonly'
 
-        for sheet_name in excel_file.sheet_names:
-            df = pd.read_excel(excel_file, sheet_name=sheet_name)
-
-            # 首先查找送货日期
-            delivery_date = None
-            for i, row in df.iterrows():
-                row_text = ' '.join(str(cell) for cell in row.values if pd.notna(cell))
-
-                # 改进日期匹配逻辑
-                date_match = re.search(r'送货时间[：:]\s*(\d{4}年\d{1,2}月\d{1,2}日|\d{4}-\d{1,2}-\d{1,2})', row_text)
-                if date_match:
-                    date_str = date_match.group(1)
-                    try:
-                        if '年' in date_str:
-                            delivery_date = datetime.strptime(date_str, '%Y年%m月%d日').date()
-                        else:
-                            delivery_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-                        print(f"找到送货日期: {delivery_date}")
-                        break
-                    except ValueError as e:
-                        print(f"日期格式转换失败: {date_str}, 错误: {e}")
-                        continue
-
-            # 如果没找到日期，尝试其他方式查找
-            if delivery_date is None:
-                print("未找到送货日期，尝试其他方式查找...")
-                for i, row in df.iterrows():
-                    for j, cell in enumerate(row.values):
-                        if pd.notna(cell):
-                            cell_str = str(cell)
-                            # 检查单元格是否包含日期格式
-                            date_match = re.search(r'(\d{4}年\d{1,2}月\d{1,2}日|\d{4}-\d{1,2}-\d{1,2})', cell_str)
-                            if date_match:
-                                date_str = date_match.group(1)
-                                try:
-                                    if '年' in date_str:
-                                        delivery_date = datetime.strptime(date_str, '%Y年%m月%d日').date()
-                                    else:
-                                        delivery_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-                                    print(f"通过其他方式找到送货日期: {delivery_date}")
-                                    break
-                                except ValueError:
-                                    continue
-                    if delivery_date is not None:
-                        break
-
-            # 如果仍然没找到日期，使用默认日期（当前日期）
-            if delivery_date is None:
-                delivery_date = datetime.now().date()
-                print(f"未找到送货日期，使用当前日期: {delivery_date}")
-
-            # 查找所有送货单
-            delivery_notes = find_delivery_notes(df)
-            print(f"找到 {len(delivery_notes)} 个送货单")
+        # 单次扫描每个工作表：查找送货日期、送货单和商品
+        for sheet_name, delivery_date, delivery_notes in scan_workbook(file_path, result['engine'],
+                                                                       result['timings'], result['sheets']):
+            logger.debug(f"工作表 {sheet_name} 找到 {len(delivery_notes)} 个送货单")
 
             for note in delivery_notes:
-                products = extract_products_from_delivery_note(
-                    df, note['start_row'], note['end_row'])
-                print(f"提取到 {len(products)} 个商品")
-
-                # 确保送货日期不为空
-                note['info']['delivery_date'] = delivery_date
-                print(f"设置送货日期: {delivery_date}")
+                products = note['products']
+                log_sampled('note_products', "提取到 %s 个商品", len(products))
 
                 if products:
-                    print("准备保存到数据库...")
                     result['delivery_notes'].append({
                         'info': note['info'],
-                        'products': products
+                        'products': products,
+                        'failed_rows': note['failed_rows']
                     })
-
-                    # 保存到数据库
-                    if save_to_database(result['file_name'], note['info'], products):
-                        result['saved_to_db'] = True
-                        print(f"成功保存 {len(products)} 个商品到数据库")
-                    else:
-                        print(f"保存到数据库失败")
                 else:
-                    print("没有提取到商品，跳过保存")
+                    log_sampled('note_empty', "没有提取到商品，跳过保存")
     except Exception as e:
         result['error'] = str(e)
-        print(f"处理文件时出错: {e}")
+        logger.error(f"处理文件时出错: {e}")
+
+    # 本文件的表头版式命中已知模板和新识别的次数
+    result['template_hits'] = template_registry.hits - hits
+    result['template_misses'] = template_registry.misses - misses
+
+    if parsed_cache_enabled() and result['error'] is None:
+        started = time.perf_counter()
+        try:
+            write_parsed_cache(sha256, result)
+            result['parsed_cache'] = 'written'
+        except Exception as e:
+            logger.warning(f"写入解析缓存失败: {e}")
+        add_stage_seconds(result['timings'], 'parsed_cache', cache_seconds + time.perf_counter() - started)
+    return result
+
+
+def uploaded_file_name(sha256: str) -> Optional[str]:
+    """按内容保存的文件的原文件名：优先用入库时的文件名，其次用清单中最早上传的文件名"""
+    manifest = UploadManifest.__table__
+    ingested = IngestedContent.__table__
+    with get_engine().connect() as conn:
+        return conn.execute(select(ingested.c.file_name).where(ingested.c.sha256 == sha256)).scalar() or \
+            conn.execute(select(manifest.c.file_name).where(manifest.c.sha256 == sha256)
+                         .order_by(manifest.c.uploaded_time, manifest.c.file_name).limit(1)).scalar()
+
+
+def build_parsed_cache(directory: Optional[str] = None) -> Dict[str, int]:
+    """解析目录（默认 UPLOAD_DIR，包括按内容保存的文件）下所有还没有当前版本缓存的 Excel 文件，写入列式缓存
+
+    按内容保存的文件使用上传时的文件名（见 uploaded_file_name），找不到原文件名的跳过。
+    """
+    object_dir = os.path.join(UPLOAD_DIR, UPLOAD_OBJECT_DIR)
+    counts = Counter()
+    for root, _, names in os.walk(directory or UPLOAD_DIR):
+        in_objects = os.path.commonpath([os.path.abspath(root), os.path.abspath(object_dir)]) == \
+            os.path.abspath(object_dir)
+        for name in sorted(names):
+            if os.path.splitext(name)[1].lower() not in ('.xlsx', '.xlsm', '.xls'):
+                continue
+            sha256 = file_name = None
+            if in_objects:
+                sha256 = os.path.splitext(name)[0]
+                file_name = uploaded_file_name(sha256)
+                if file_name is None:
+                    logger.warning(f"找不到 {name} 的原文件名，跳过")
+                    counts['unknown'] += 1
+                    continue
+            result = parse_excel_file(os.path.join(root, name), file_name=file_name, sha256=sha256)
+            counts[result.get('parsed_cache') or 'failed'] += 1
+    return dict(counts)
+
+
+def replay_parsed_cache() -> Dict[str, int]:
+    """从当前解析器版本的列式缓存重建数据库记录（如数据库恢复后），不解析 Excel
+
+    已入库的内容（见 ingested_content）跳过，每个文件一个事务。
+    """
+    suffix = f'.v{PARSER_VERSION}.parquet'
+    names = sorted(os.listdir(PARSED_CACHE_DIR)) if os.path.isdir(PARSED_CACHE_DIR) else []
+    counts = Counter()
+    for name in names:
+        if not name.endswith(suffix):
+            continue
+        sha256 = name[:-len(suffix)]
+        if find_ingested_content(sha256) is not None:
+            counts['skipped'] += 1
+            continue
+
+        cached = read_parsed_cache(sha256)
+        if not cached['delivery_notes']:
+            counts['empty'] += 1
+            continue
+        try:
+            save_file_to_database(cached['file_name'], cached['delivery_notes'], sha256)
+            counts['saved'] += 1
+        except Exception as e:
+            logger.error(f"从解析缓存重建 {cached['file_name']} 失败: {e}")
+            counts['failed'] += 1
+    return dict(counts)
+
+
+def save_excel_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """把 parse_excel_file 的解析结果保存到数据库（整个文件一个事务）"""
+    if result['delivery_notes']:
+        logger.debug("准备保存到数据库...")
+        started = time.perf_counter()
+        try:
+            save_file_to_database(result['file_name'], result['delivery_notes'], result.get('sha256'))
+            result['saved_to_db'] = True
+        except DuplicateContentError:
+            result['duplicate_of'] = find_ingested_content(result['sha256'])
+            logger.info(f"同样内容已由 {result['duplicate_of']} 入库，跳过保存")
+        except Exception as e:
+            logger.exception(f"数据库保存失败: {e}")
+            result['error'] = f"数据库保存失败: {e}"
+        add_stage_seconds(result.setdefault('timings', {}), 'db_save', time.perf_counter() - started)
+
+    return result
+
+
+def process_excel_file(file_path: str, streaming: Optional[bool] = None,
+                       engine: Optional[str] = None) -> Dict[str, Any]:
+    """处理单个Excel文件：解析并保存到数据库
+
+    和上传的文件一样按内容（SHA-256）记录到 ingested_content，同样内容已入库时跳过保存。
+    """
+    sha256 = file_sha256(file_path)
+    result = parse_excel_file(file_path, streaming, engine, sha256=sha256)
+    result['sha256'] = sha256
+    return save_excel_result(result)
+
+
+_ingest_pool = None
+_ingest_slots = None
+
+
+def _init_ingest_worker():
+    """子进程初始化：预先导入 pandas 和 openpyxl"""
+    pd.load()
+    openpyxl.load()
+
+
+def get_ingest_pool() -> ProcessPoolExecutor:
+    """获取（首次使用时创建）解析Excel文件的进程池
+
+    子进程由 forkserver（不支持时用 spawn）启动，不从运行中的接口进程 fork：
+    接口进程的线程可能持有日志、数据库连接池等锁，fork 后子进程可能死锁，也会继承数据库连接。
+    exceldemo3 导入时不加载 pandas 和数据库引擎，子进程启动开销很小。
+    """
+    global _ingest_pool
+    if _ingest_pool is None:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _ingest_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS, initializer=_init_ingest_worker,
+                                           mp_context=multiprocessing.get_context(method))
+    return _ingest_pool
+
+
+# 入库各阶段，以及阶段耗时直方图的桶边界（秒）
+INGEST_STAGES = ('upload_write', 'parsed_cache', 'workbook_open', 'sheet_peek', 'sheet_read', 'note_detection',
+                 'extraction', 'db_save')
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class IngestMetrics:
+    """入库指标：各阶段耗时直方图和文件/行数等计数器，按 Prometheus 文本格式输出"""
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # 阶段 -> [各桶计数, 总耗时, 次数]
+        self._histograms = {stage: [[0] * len(buckets), 0.0, 0] for stage in INGEST_STAGES}
+        self._counters = Counter()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.setdefault(stage, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe_file(self, file_status: Dict[str, Any], timings: Dict[str, float]):
+        """记录一个处理完成的文件的阶段耗时和计数"""
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds)
+        self.increment('ingest_files_total', status=file_status['state'])
+        self.increment('ingest_notes_total', file_status['delivery_notes'])
+        self.increment('ingest_rows_total', file_status['rows'])
+        self.increment('ingest_failed_rows_total', file_status['failed_rows'])
+
+    def render(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        lines = []
+        with self._lock:
+            lines.append('# TYPE ingest_stage_seconds histogram')
+            for stage, (bucket_counts, total, count) in self._histograms.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'ingest_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+                lines.append(f'ingest_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'ingest_stage_seconds_sum{{stage="{stage}"}} {total}')
+                lines.append(f'ingest_stage_seconds_count{{stage="{stage}"}} {count}')
+
+            names = sorted({name for name, _ in self._counters})
+            for name in names:
+                lines.append(f'# TYPE {name} counter')
+                for (counter_name, labels), value in sorted(self._counters.items()):
+                    if counter_name != name:
+                        continue
+                    label_text = ','.join(f'{key}="{label}"' for key, label in labels)
+                    lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        for name, value in (gauges or {}).items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+ingest_metrics = IngestMetrics()
+
+
+# 上传任务，按创建顺序保存，最多保留 MAX_INGEST_JOBS 个
+MAX_INGEST_JOBS = int(os.getenv('MAX_INGEST_JOBS', 200))
+ingest_jobs: Dict[str, Dict[str, Any]] = {}
+_ingest_tasks = set()
+
+
+def create_ingest_job(file_names: List[str], file_sizes: Optional[List[int]] = None,
+                      file_hashes: Optional[List[str]] = None) -> Dict[str, Any]:
+    """创建上传任务，每个文件初始状态为 queued"""
+    # 清理最早的已完成任务
+    for job_id in list(ingest_jobs):
+        if len(ingest_jobs) < MAX_INGEST_JOBS:
+            break
+        if ingest_jobs[job_id]['state'] == 'done':
+            del ingest_jobs[job_id]
+
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'state': 'queued',
+        'created_time': datetime.now().isoformat(),
+        'finished_time': None,
+        'files': [
+            {
+                'file_name': file_name,
+                'state': 'queued',
+                'bytes': file_size,
+                'sha256': file_hash,
+                'duplicate_of': None,
+                'delivery_notes': 0,
+                'rows': 0,
+                'failed_rows': 0,
+                'sheets_skipped': 0,
+                'skip_saved_seconds': 0.0,
+                'error': None,
+                'parse_seconds': None,
+                'save_seconds': None,
+                'timings': {}
+            }
+            for file_name, file_size, file_hash in zip(file_names, file_sizes or [None] * len(file_names),
+                                                       file_hashes or [None] * len(file_names))
+        ],
+        'process_results': []
+    }
+    ingest_jobs[job['job_id']] = job
+    return job
+
+
+def skip_duplicate_file(file_status: Dict[str, Any], duplicate_of: str) -> Dict[str, Any]:
+    """同样内容已入库（或在同一任务中排在前面）的文件：不解析、不入库，标记为 skipped"""
+    file_status['state'] = 'skipped'
+    file_status['duplicate_of'] = duplicate_of
+    ingest_metrics.observe_file(file_status, {})
+    return {
+        'file_name': file_status['file_name'],
+        'delivery_notes': [],
+        'saved_to_db': False,
+        'duplicate_of': duplicate_of,
+        'error': None
+    }
+
 
+def failed_file_result(file_status: Dict[str, Any], error: str) -> Dict[str, Any]:
+    """未能解析的文件的处理结果"""
+    return {
+        'file_name': file_status['file_name'],
+        'delivery_notes': [],
+        'saved_to_db': False,
+        'error': error
+    }
+
+
+async def _ingest_job_file(file_status: Dict[str, Any], file_path: str,
+                           streaming: Optional[bool]) -> Dict[str, Any]:
+    """在进程池中解析一个文件，再在线程中保存到数据库，并更新文件状态"""
+    global _ingest_pool, _ingest_slots
+    loop = asyncio.get_running_loop()
+    if _ingest_slots is None:
+        _ingest_slots = asyncio.Semaphore(INGEST_WORKERS)
+
+    # 同样内容已经入库过（包括之前以其他文件名上传的）：跳过解析和入库
+    sha256 = file_status.get('sha256')
+    result = None
+    if sha256 is not None:
+        try:
+            duplicate_of = await loop.run_in_executor(None, find_ingested_content, sha256)
+        except Exception as e:
+            logger.error(f"查询文件 {file_status['file_name']} 是否已入库时出错: {e}")
+            result = failed_file_result(file_status, f"查询是否已入库时出错: {e}")
+        else:
+            if duplicate_of is not None:
+                return skip_duplicate_file(file_status, duplicate_of)
+
+    if result is None:
+        async with _ingest_slots:
+            pool = get_ingest_pool()
+            try:
+                file_status['state'] = 'parsing'
+                started = time.perf_counter()
+                # 文件按内容保存，入库时使用上传时的文件名
+                result = await loop.run_in_executor(pool, functools.partial(
+                    parse_excel_file, file_path, streaming, file_name=file_status['file_name'], sha256=sha256))
+                file_status['parse_seconds'] = round(time.perf_counter() - started, 3)
+                result['sha256'] = sha256
+            except Exception as e:
+                logger.error(f"处理文件 {file_path} 时进程出错: {e}")
+                # 子进程异常退出后进程池不可再用，下次重新创建
+                if isinstance(e, BrokenProcessPool) and _ingest_pool is pool:
+                    _ingest_pool = None
+                result = failed_file_result(file_status, str(e))
+
+    file_status['delivery_notes'] = len(result['delivery_notes'])
+    file_status['rows'] = sum(len(note['products']) for note in result['delivery_notes'])
+    file_status['failed_rows'] = sum(len(note['failed_rows']) for note in result['delivery_notes'])
+
+    if result['delivery_notes']:
+        file_status['state'] = 'saving'
+        started = time.perf_counter()
+        result = await loop.run_in_executor(None, save_excel_result, result)
+        file_status['save_seconds'] = round(time.perf_counter() - started, 3)
+        if result['saved_to_db']:
+            bump_ingest_generation()
+
+    # 预筛选跳过的工作表数和估算节省的读取时间
+    skipped_sheets = [report for report in result.get('sheets', []) if report['skipped']]
+    file_status['sheets_skipped'] = len(skipped_sheets)
+    file_status['skip_saved_seconds'] = round(sum(report['saved_seconds'] or 0 for report in skipped_sheets), 3)
+    ingest_metrics.increment('ingest_sheets_total', len(result.get('sheets', [])) - len(skipped_sheets),
+                             result='read')
+    ingest_metrics.increment('ingest_sheets_total', len(skipped_sheets), result='skipped')
+
+    file_status['error'] = result['error']
+    if result.get('duplicate_of') is not None:
+        # 同时处理的同样内容的文件已先入库
+        file_status['state'] = 'skipped'
+        file_status['duplicate_of'] = result['duplicate_of']
+    else:
+        file_status['state'] = 'done' if result['saved_to_db'] else 'failed'
+    timings = result.get('timings', {})
+    file_status['timings'].update((stage, round(seconds, 3)) for stage, seconds in timings.items())
+    ingest_metrics.observe_file(file_status, timings)
+    ingest_metrics.increment('ingest_template_lookups_total', result.get('template_hits', 0), result='hit')
+    ingest_metrics.increment('ingest_template_lookups_total', result.get('template_misses', 0), result='miss')
     return result
 
-@app.post("/upload")
-async def upload_files(files: List[UploadFile] = File(...)):
+
+class IngestScheduler:
+    """全局入库调度器：限制同时处理的文件数和排队的文件数
+
+    每个客户端一个队列，按客户端轮流取文件处理，避免一次上传大量文件的客户端阻塞其他客户端。
+    上传时先 reserve 排队名额，名额不足时返回 429 和 Retry-After。
+    """
+
+    def __init__(self, max_in_flight: int, max_queued: int):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self._queues: 'OrderedDict[str, deque]' = OrderedDict()
+        self._queued = 0
+        self._in_flight = 0
+        # 单个文件处理耗时的滑动平均（秒），用于估算 Retry-After
+        self._average_seconds = None
+
+    def retry_after(self) -> int:
+        """估算排队文件全部开始处理所需的秒数"""
+        average_seconds = self._average_seconds or 5.0
+        return max(1, math.ceil(average_seconds * self._queued / self.max_in_flight))
+
+    def reserve(self, count: int):
+        """为即将提交的 count 个文件预留排队名额
+
+        count 超过队列上限时重试也不会成功，返回 413 而不是 429。
+        """
+        if count > self.max_queued:
+            raise HTTPException(status_code=413,
+                                detail=f"单次上传的文件数超过处理队列上限（{self.max_queued}个），请分批上传")
+        if self._queued + count > self.max_queued:
+            raise HTTPException(status_code=429, detail="上传处理队列已满，请稍后重试",
+                                headers={'Retry-After': str(self.retry_after())})
+        self._queued += count
+
+    def release(self, count: int):
+        """释放未提交文件的排队名额"""
+        self._queued -= count
+
+    def submit(self, client: str, file_status: Dict[str, Any], file_path: str,
+               streaming: Optional[bool]) -> asyncio.Future:
+        """提交一个已预留名额的文件，返回处理结果的 Future"""
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(client, deque()).append((file_status, file_path, streaming, future))
+        self._dispatch()
+        return future
+
+    def stats(self) -> Dict[str, int]:
+        return {'in_flight': self._in_flight, 'queued': self._queued, 'clients': len(self._queues)}
+
+    def _dispatch(self):
+        while self._in_flight < self.max_in_flight and self._queues:
+            client, queue = next(iter(self._queues.items()))
+            item = queue.popleft()
+            # 轮转：取过文件的客户端排到最后
+            if queue:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            self._queued -= 1
+            self._in_flight += 1
+            task = asyncio.create_task(self._run(*item))
+            _ingest_tasks.add(task)
+            task.add_done_callback(_ingest_tasks.discard)
+
+    async def _run(self, file_status: Dict[str, Any], file_path: str, streaming: Optional[bool],
+                   future: asyncio.Future):
+        started = time.perf_counter()
+        try:
+            future.set_result(await _ingest_job_file(file_status, file_path, streaming))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._average_seconds = elapsed if self._average_seconds is None \
+                else 0.8 * self._average_seconds + 0.2 * elapsed
+            self._in_flight -= 1
+            self._dispatch()
+
+
+ingest_scheduler = IngestScheduler(MAX_INGEST_IN_FLIGHT, MAX_INGEST_QUEUE)
+
+
+def summarize_file_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """任务中保留的单个文件处理结果：只有计数、状态和工作表记录，不保留送货单和商品明细"""
+    notes = result['delivery_notes']
+    return {
+        'file_name': result['file_name'],
+        'saved_to_db': result['saved_to_db'],
+        'duplicate_of': result.get('duplicate_of'),
+        'error': result['error'],
+        'delivery_notes': len(notes),
+        'rows': sum(len(note['products']) for note in notes),
+        'failed_rows': sum(len(note['failed_rows']) for note in notes),
+        'sheets': result.get('sheets', [])
+    }
+
+
+async def run_ingest_job(job: Dict[str, Any], file_paths: List[str], streaming: Optional[bool] = None,
+                         client: str = ''):
+    """后台处理上传任务中的所有文件（通过调度器排队），已标记为重复的文件不再处理
+
+    每个文件处理完后只保留摘要（summarize_file_result），商品明细在入库后即释放。
+    """
+    async def ingest(file_status: Dict[str, Any], file_path: str) -> Dict[str, Any]:
+        try:
+            if file_status['state'] == 'skipped':
+                return summarize_file_result(skip_duplicate_file(file_status, file_status['duplicate_of']))
+            return summarize_file_result(await ingest_scheduler.submit(client, file_status, file_path, streaming))
+        finally:
+            await release_object(file_path)
+
+    job['state'] = 'running'
+    try:
+        results = await asyncio.gather(*(
+            ingest(file_status, file_path) for file_status, file_path in zip(job['files'], file_paths)
+        ), return_exceptions=True)
+
+        # 处理中意外出错的文件标记为失败，任务仍然结束
+        for index, (file_status, result) in enumerate(zip(job['files'], results)):
+            if isinstance(result, BaseException):
+                logger.error(f"处理文件 {file_status['file_name']} 时出错: {result}")
+                if file_status['state'] not in ('done', 'skipped'):
+                    file_status['state'] = 'failed'
+                    file_status['error'] = str(result)
+                results[index] = summarize_file_result(failed_file_result(file_status, str(result)))
+        job['process_results'] = results
+    finally:
+        job['state'] = 'done'
+        job['finished_time'] = datetime.now().isoformat()
+
+
+def start_ingest_job(job: Dict[str, Any], file_paths: List[str], streaming: Optional[bool] = None,
+                     client: str = ''):
+    """在后台启动上传任务（保留任务引用，避免被垃圾回收）"""
+    # 处理完成前文件不会被删除（见 remove_objects）
+    _active_objects.update(file_paths)
+    task = asyncio.create_task(run_ingest_job(job, file_paths, streaming, client))
+    _ingest_tasks.add(task)
+    task.add_done_callback(_ingest_tasks.discard)
+
+
+def shutdown_ingest_pool():
+    global _ingest_pool
+    if _ingest_pool is not None:
+        _ingest_pool.shutdown(wait=False, cancel_futures=True)
+        _ingest_pool = None
+
+
+def upload_object_path(sha256: str, file_name: str) -> str:
+    """按内容保存的文件路径：UPLOAD_DIR/objects/<SHA-256 前两位>/<SHA-256><扩展名>"""
+    extension = os.path.splitext(file_name)[1].lower()
+    return os.path.join(UPLOAD_DIR, UPLOAD_OBJECT_DIR, sha256[:2], sha256 + extension)
+
+
+def save_upload_file(file: UploadFile, remaining_size: int) -> Dict[str, Any]:
+    """分块把上传文件复制到临时文件，复制时同时计算 SHA-256，完成后原子重命名为按内容保存的路径
+
+    阻塞的文件读写和哈希计算，在线程池中调用。Starlette 在调用接口前已经接收完整个请求体，
+    并把文件缓存在临时文件中（file.file），这里只是把它复制到 UPLOAD_DIR，
+    因此大小限制不能减少接收的数据量，只能避免保存超限的文件（能提前拒绝的只有 Content-Length 检查）。
+
+    返回 path、size、sha256，以及 created（False 表示同样内容的文件已存在，未重复保存）。
+    文件超过 MAX_UPLOAD_FILE_SIZE，或超过本次请求剩余的 remaining_size 时删除临时文件并返回 413。
+    """
+    fd, temp_path = tempfile.mkstemp(dir=UPLOAD_DIR, prefix='.upload-', suffix='.part')
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = file.file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_FILE_SIZE:
+                    raise HTTPException(status_code=413, detail=f"文件 {file.filename} 超过大小限制")
+                if size > remaining_size:
+                    raise HTTPException(status_code=413, detail="上传文件总大小超过限制")
+                digest.update(chunk)
+                f.write(chunk)
+
+        sha256 = digest.hexdigest()
+        object_path = upload_object_path(sha256, file.filename)
+        created = not os.path.exists(object_path)
+        if created:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(temp_path, object_path)
+        else:
+            os.remove(temp_path)
+        return {'path': object_path, 'size': size, 'sha256': sha256, 'created': created}
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _unreferenced_objects(conn, entries) -> List[str]:
+    """entries 为 (文件名, SHA-256)，返回清单中已不再引用的按内容保存的文件路径"""
+    table = UploadManifest.__table__
+    candidates = {upload_object_path(sha256, file_name) for file_name, sha256 in entries}
+    if not candidates:
+        return []
+    referenced = {
+        upload_object_path(sha256, file_name)
+        for file_name, sha256 in conn.execute(
+            select(table.c.file_name, table.c.sha256)
+            .where(table.c.sha256.in_({sha256 for _, sha256 in entries}))
+        )
+    }
+    return sorted(candidates - referenced)
+
+
+def register_uploads(uploads: List[Dict[str, Any]]) -> List[str]:
+    """把上传的文件写入清单（同名文件改为指向新内容），返回不再被引用、可以删除的文件路径"""
+    table = UploadManifest.__table__
+    # 同一请求中的同名文件以最后一个为准
+    latest = {upload['file_name']: upload for upload in uploads}
+    with get_engine().begin() as conn:
+        previous = conn.execute(
+            select(table.c.file_name, table.c.sha256).where(table.c.file_name.in_(latest))
+        ).all()
+        conn.execute(delete(table).where(table.c.file_name.in_(latest)))
+        conn.execute(insert(table), [
+            {'file_name': file_name, 'sha256': upload['sha256'], 'size': upload['size']}
+            for file_name, upload in latest.items()
+        ])
+        return _unreferenced_objects(conn, previous)
+
+
+def unregister_upload(file_name: str) -> Optional[List[str]]:
+    """从清单中删除文件，返回不再被引用、可以删除的文件路径；文件不在清单中时返回 None"""
+    table = UploadManifest.__table__
+    with get_engine().begin() as conn:
+        sha256 = conn.execute(select(table.c.sha256).where(table.c.file_name == file_name)).scalar()
+        if sha256 is None:
+            return None
+        conn.execute(delete(table).where(table.c.file_name == file_name))
+        return _unreferenced_objects(conn, [(file_name, sha256)])
+
+
+def find_ingested_content(sha256: str) -> Optional[str]:
+    """同样内容已入库时返回入库时的文件名"""
+    table = IngestedContent.__table__
+    with get_engine().connect() as conn:
+        return conn.execute(select(table.c.file_name).where(table.c.sha256 == sha256)).scalar()
+
+
+def remove_files(paths: List[str]):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# 未完成的上传任务引用的按内容保存的文件（只在事件循环中访问），
+# 这些文件不再被清单引用时推迟到任务处理完再删除
+_active_objects = Counter()
+_deferred_removals = set()
+
+
+def remove_objects(paths: List[str]):
+    """删除不再被清单引用的按内容保存的文件，仍有任务在处理的推迟删除"""
+    for path in paths:
+        if _active_objects[path]:
+            _deferred_removals.add(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def object_referenced(path: str) -> bool:
+    """清单中是否有文件指向该按内容保存的文件"""
+    table = UploadManifest.__table__
+    sha256 = os.path.splitext(os.path.basename(path))[0]
+    with get_engine().connect() as conn:
+        names = conn.execute(select(table.c.file_name).where(table.c.sha256 == sha256)).scalars()
+        return any(upload_object_path(sha256, name) == path for name in names)
+
+
+async def release_object(path: str):
+    """任务处理完一个文件：没有任务再使用且已推迟删除的文件，确认仍未被重新引用后删除"""
+    _active_objects[path] -= 1
+    if _active_objects[path] > 0:
+        return
+    del _active_objects[path]
+    if path in _deferred_removals:
+        _deferred_removals.discard(path)
+        if not await run_in_threadpool(object_referenced, path):
+            remove_files([path])
+
+
+@router.post("/upload")
+async def upload_files(request: Request, files: List[UploadFile] = File(...),
+                       streaming: Optional[bool] = Query(None, description="是否流式读取，不指定时自动选择读取引擎")):
     if len(files) > 100:
         raise HTTPException(status_code=400, detail="最多只能上传100个文件")
 
@@ -410,56 +2155,273 @@ async def upload_files(files: List[UploadFile] = File(...)):
         if not file.filename.endswith('.xls') and not file.filename.endswith('.xlsx'):
             raise HTTPException(status_code=400, detail="只能上传.xls或.xlsx文件")
 
-    saved_files = []
-    file_paths = []
-    process_results = []  # 确保初始化为空列表而不是None
+    # 能提前知道大小时尽早拒绝超限的上传
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_REQUEST_SIZE:
+        raise HTTPException(status_code=413, detail="上传文件总大小超过限制")
+    for file in files:
+        if file.size is not None and file.size > MAX_UPLOAD_FILE_SIZE:
+            raise HTTPException(status_code=413, detail=f"文件 {file.filename} 超过大小限制")
+
+    # 排队名额不足时返回 429，客户端按 Retry-After 重试
+    ingest_scheduler.reserve(len(files))
+    # 按客户端公平调度，可用 X-Client-Id 区分同一地址后的不同客户端
+    client = request.headers.get('x-client-id') or (request.client.host if request.client else '')
+
+    uploads = []
+    upload_seconds = []
+    total_size = 0
 
     try:
         for file in files:
-            file_path = os.path.join(UPLOAD_DIR, file.filename)
-            with open(file_path, "wb") as f:
-                content = await file.read()
-                f.write(content)
-            saved_files.append(file.filename)
-            file_paths.append(file_path)
-
-        # 处理Excel文件并保存到数据库
-        process_results = []
-        for file_path in file_paths:
-            result = process_excel_file(file_path)
-            if result is not None:  # 确保result不是None
-                process_results.append(result)
-            else:
-                logger.error(f"处理文件 {file_path} 返回了None")
-
-        # 统计处理结果
-        success_count = sum(1 for r in process_results if r.get('saved_to_db', False))
-        error_count = len(process_results) - success_count
+            started = time.perf_counter()
+            upload = await run_in_threadpool(save_upload_file, file, MAX_UPLOAD_REQUEST_SIZE - total_size)
+            upload['file_name'] = os.path.basename(file.filename)
+            upload_seconds.append(time.perf_counter() - started)
+            total_size += upload['size']
+            uploads.append(upload)
+            ingest_metrics.observe('upload_write', upload_seconds[-1])
+            ingest_metrics.increment('ingest_upload_bytes_total', upload['size'])
+
+        # 同名文件改为指向新内容，删除不再被引用的旧内容
+        remove_objects(await run_in_threadpool(register_uploads, uploads))
+        bump_ingest_generation()
+
+        # 文件在后台解析并保存到数据库，通过 /jobs/{job_id} 查询进度
+        saved_files = [upload['file_name'] for upload in uploads]
+        job = create_ingest_job(saved_files, [upload['size'] for upload in uploads],
+                                [upload['sha256'] for upload in uploads])
+        for file_status, seconds in zip(job['files'], upload_seconds):
+            file_status['timings']['upload_write'] = round(seconds, 3)
+
+        # 同一请求中内容相同的文件只处理第一个，其余标记为重复并释放排队名额
+        first_by_hash = {}
+        for file_status in job['files']:
+            first = first_by_hash.setdefault(file_status['sha256'], file_status)
+            if first is not file_status:
+                file_status['state'] = 'skipped'
+                file_status['duplicate_of'] = first['file_name']
+                ingest_scheduler.release(1)
+        start_ingest_job(job, [upload['path'] for upload in uploads], streaming, client)
 
         return {
-            "message": f"文件处理完成，成功保存{success_count}个，失败{error_count}个",
-            "files": saved_files,
-            "process_results": process_results
+            "message": f"文件上传成功，共{len(saved_files)}个，正在后台处理",
+            "job_id": job['job_id'],
+            "files": saved_files
         }
+    except HTTPException:
+        # 超过大小限制：删除本次请求新保存的文件（已存在的同内容文件保留）
+        ingest_scheduler.release(len(files))
+        remove_files([upload['path'] for upload in uploads if upload['created']])
+        raise
     except Exception as e:
+        ingest_scheduler.release(len(files))
         logger.error(f"上传文件时出错: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"文件处理出错: {str(e)}")
 
-@app.get("/check-price-inconsistencies")
-async def check_price_inconsistencies():
-    """检查数据库中价格不一致的商品"""
-    db = SessionLocal()
+
+@router.get("/metrics")
+async def metrics():
+    """Prometheus 格式的入库指标"""
+    stats = ingest_scheduler.stats()
+    cache_stats = result_cache.stats()
+    body = ingest_metrics.render({
+        'ingest_files_in_flight': stats['in_flight'],
+        'ingest_files_queued': stats['queued'],
+        'ingest_generation': ingest_generation,
+        'result_cache_entries': cache_stats['entries'],
+        'result_cache_bytes': cache_stats['bytes']
+    })
+    return Response(content=body, media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询上传任务的处理进度"""
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    counts = {}
+    for file_status in job['files']:
+        counts[file_status['state']] = counts.get(file_status['state'], 0) + 1
+
+    response = {
+        'job_id': job['job_id'],
+        'state': job['state'],
+        'created_time': job['created_time'],
+        'finished_time': job['finished_time'],
+        'counts': counts,
+        'files': job['files'],
+        'ingest_queue': ingest_scheduler.stats()
+    }
+    if job['state'] == 'done':
+        success_count = counts.get('done', 0)
+        skipped_count = counts.get('skipped', 0)
+        response['message'] = (f"文件处理完成，成功保存{success_count}个，跳过重复内容{skipped_count}个，"
+                               f"失败{len(job['files']) - success_count - skipped_count}个")
+        response['process_results'] = job['process_results']
+    return response
+
+
+# 读接口的结果缓存：条目数上限、响应体总字节数上限、单个响应体的字节数上限（更大的不缓存）和过期时间（秒）
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 256))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv('RESULT_CACHE_MAX_ENTRY_BYTES', 4 * 1024 * 1024))
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', 300))
+
+# 入库版本号：上传、入库和删除文件后递增，缓存键包含该版本号，数据变化后旧缓存自然失效。
+# 版本号只在当前进程内：多个接口进程时，其他进程的缓存以及 rebuild-summary、replay-parsed-cache
+# 等命令行修改数据后所有进程的缓存，要到 RESULT_CACHE_TTL 过期后才更新
+ingest_generation = 0
+
+
+def bump_ingest_generation():
+    global ingest_generation
+    ingest_generation += 1
+
+
+class ResultCache:
+    """带过期时间的 LRU 结果缓存，保存序列化后的 JSON 响应体及其 ETag
+
+    按条目数和响应体总字节数淘汰最久未使用的条目；超过 max_entry_bytes 的响应体不缓存（仍返回 ETag）。
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int, max_entry_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[Tuple[str, bytes]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, etag, body = entry
+            if expires < time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return etag, body
+
+    def set(self, key, body: bytes) -> Tuple[str, bytes]:
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        if len(body) > self.max_entry_bytes:
+            return etag, body
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, etag, body)
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+        return etag, body
+
+    def _pop(self, key):
+        self._bytes -= len(self._entries.pop(key)[2])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_MAX_ENTRY_BYTES)
+
+
+async def cached_json_response(request: Request, compute) -> Response:
+    """读穿缓存：按 路径 + 查询参数 + 入库版本号 缓存 await compute() 的结果，
+    返回 ETag，If-None-Match 命中时返回 304
+    """
+    key = (ingest_generation, request.url.path, tuple(sorted(request.query_params.multi_items())))
+    entry = result_cache.get(key)
+    if entry is None:
+        body = json.dumps(jsonable_encoder(await compute()), ensure_ascii=False).encode('utf-8')
+        entry = result_cache.set(key, body)
+    etag, body = entry
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and (if_none_match.strip() == '*' or
+                          etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))):
+        return Response(status_code=304, headers={'ETag': etag})
+    return Response(content=body, media_type='application/json', headers={'ETag': etag})
+
+
+def encode_inconsistency_cursor(delivery_date, product_name: str) -> str:
+    """把分页位置（日期, 商品名称）编码为游标字符串"""
+    payload = json.dumps([str(delivery_date), product_name], ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_inconsistency_cursor(cursor: str):
+    """解析游标字符串，格式错误时返回 400"""
     try:
-        # 查询所有记录
-        records = db.query(HongshanShixiaoDelivery).all()
+        delivery_date, product_name = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.strptime(delivery_date, '%Y-%m-%d').date(), product_name
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"无效的分页游标: {e}")
+
+
+def iter_price_inconsistencies(db, start_date=None, end_date=None, product_prefix: Optional[str] = None,
+                               ordering_unit: Optional[str] = None, delivery_unit: Optional[str] = None,
+                               min_spread: Optional[float] = None, after=None, limit: Optional[int] = None,
+                               chunk_size: int = 200):
+    """按（日期, 商品名称）顺序逐个产出价格不一致的商品
+
+    从增量维护的价格汇总表中按键集分页查出结算价不唯一的组，每次 chunk_size 组，
+    再只查询这些组的明细，内存占用与结果总数无关。
+    after 为上一页最后一组的（日期, 商品名称）。
+    """
+    table = HongshanShixiaoDelivery
+    keys_query = select(PriceSummary.delivery_date, PriceSummary.product_name).where(PriceSummary.price_count > 1)
+    if start_date is not None:
+        keys_query = keys_query.where(PriceSummary.delivery_date >= start_date)
+    if end_date is not None:
+        keys_query = keys_query.where(PriceSummary.delivery_date <= end_date)
+    if product_prefix:
+        keys_query = keys_query.where(PriceSummary.product_name.startswith(product_prefix, autoescape=True))
+    if min_spread is not None:
+        keys_query = keys_query.where(PriceSummary.max_price - PriceSummary.min_price >= min_spread)
+    for column, value in ((table.ordering_unit, ordering_unit), (table.delivery_unit, delivery_unit)):
+        if value:
+            keys_query = keys_query.where(
+                select(table.id)
+                .where(table.delivery_date == PriceSummary.delivery_date,
+                       table.product_name == PriceSummary.product_name,
+                       column == value)
+                .exists()
+            )
+    keys_query = keys_query.order_by(PriceSummary.delivery_date, PriceSummary.product_name)
+
+    produced = 0
+    while limit is None or produced < limit:
+        page_query = keys_query
+        if after is not None:
+            page_query = page_query.where(tuple_(PriceSummary.delivery_date, PriceSummary.product_name) > tuple_(*after))
+        page_size = chunk_size if limit is None else min(chunk_size, limit - produced)
+        keys = [tuple(row) for row in db.execute(page_query.limit(page_size))]
+        if not keys:
+            break
+
+        records = db.execute(
+            select(table.delivery_date, table.product_name, table.file_name, table.ordering_unit,
+                   table.delivery_unit, table.settlement_price, table.created_time)
+            .where(tuple_(table.delivery_date, table.product_name).in_(keys))
+            .order_by(table.delivery_date, table.product_name, table.id)
+        )
 
         # 按日期和商品名称分组
-        date_product_map = {}
+        date_product_map = {key: [] for key in keys}
         for record in records:
-            key = (record.delivery_date, record.product_name)
-            if key not in date_product_map:
-                date_product_map[key] = []
-            date_product_map[key].append({
+            date_product_map[(record.delivery_date, record.product_name)].append({
                 'file_name': record.file_name,
                 'ordering_unit': record.ordering_unit,
                 'delivery_unit': record.delivery_unit,
@@ -467,92 +2429,366 @@ async def check_price_inconsistencies():
                 'created_time': record.created_time
             })
 
-        # 找出价格不一致的商品
-        inconsistencies = []
         for (date, product_name), items in date_product_map.items():
-            prices = set(item['settlement_price'] for item in items)
-            if len(prices) > 1:
-                inconsistencies.append({
-                    'delivery_date': date.strftime('%Y-%m-%d'),
-                    'product_name': product_name,
-                    'price_variations': list(prices),
-                    'records': items
-                })
+            yield {
+                'delivery_date': date.strftime('%Y-%m-%d'),
+                'product_name': product_name,
+                'price_variations': list(dict.fromkeys(item['settlement_price'] for item in items)),
+                'records': items
+            }
 
+        produced += len(keys)
+        after = keys[-1]
+        if len(keys) < page_size:
+            break
+
+
+def find_price_inconsistencies(db, **filters) -> List[Dict[str, Any]]:
+    """在数据库中找出同一天同一商品有多个结算价的记录，参数同 iter_price_inconsistencies"""
+    return list(iter_price_inconsistencies(db, **filters))
+
+
+@router.get("/check-price-inconsistencies")
+async def check_price_inconsistencies(
+        request: Request,
+        start_date: Optional[date] = Query(None, description="送货日期起（含）"),
+        end_date: Optional[date] = Query(None, description="送货日期止（含）"),
+        product_prefix: Optional[str] = Query(None, description="商品名称前缀"),
+        ordering_unit: Optional[str] = Query(None, description="订货单位"),
+        delivery_unit: Optional[str] = Query(None, description="送货单位"),
+        min_spread: Optional[float] = Query(None, ge=0, description="最高价与最低价的最小差额"),
+        cursor: Optional[str] = Query(None, description="上一页返回的 next_cursor"),
+        limit: Optional[int] = Query(None, ge=1, le=1000, description="每页条数，不指定时返回全部"),
+        format: str = Query('json', pattern='^(json|ndjson)$', description="ndjson 时逐行流式返回"),
+        db=Depends(get_db)):
+    """检查数据库中价格不一致的商品"""
+    filters = {
+        'start_date': start_date,
+        'end_date': end_date,
+        'product_prefix': product_prefix,
+        'ordering_unit': ordering_unit,
+        'delivery_unit': delivery_unit,
+        'min_spread': min_spread,
+        'after': decode_inconsistency_cursor(cursor) if cursor else None,
+        'limit': limit
+    }
+
+    if format == 'ndjson':
+        def generate():
+            db = SessionLocal()
+            try:
+                for item in iter_price_inconsistencies(db, **filters):
+                    yield json.dumps(jsonable_encoder(item), ensure_ascii=False) + '\n'
+            finally:
+                db.close()
+
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+    async def compute():
+        try:
+            inconsistencies = await run_db(db, find_price_inconsistencies, **filters)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"查询数据库时出错: {str(e)}")
+        next_cursor = None
+        if limit is not None and len(inconsistencies) == limit:
+            last = inconsistencies[-1]
+            next_cursor = encode_inconsistency_cursor(last['delivery_date'], last['product_name'])
         return {
             "count": len(inconsistencies),
-            "inconsistencies": inconsistencies
+            "inconsistencies": inconsistencies,
+            "next_cursor": next_cursor
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"查询数据库时出错: {str(e)}")
-    finally:
-        db.close()
+
+    return await cached_json_response(request, compute)
+
+
+# 价格统计的分组方式：按天、按送货单位、按订货单位
+PRICE_GROUP_COLUMNS = {
+    'day': 'delivery_date',
+    'delivery_unit': 'delivery_unit',
+    'ordering_unit': 'ordering_unit',
+}
+
+
+def query_price_rollups(db, product_names: List[str], group_by: str = 'day',
+                        start_date=None, end_date=None) -> Dict[str, List[Dict[str, Any]]]:
+    """从每日价格汇总表统计每个商品每组的最低/最高/平均/最新结算价"""
+    rollup = DailyPriceRollup
+    query = select(rollup).where(rollup.product_name.in_(product_names))
+    if start_date is not None:
+        query = query.where(rollup.delivery_date >= start_date)
+    if end_date is not None:
+        query = query.where(rollup.delivery_date <= end_date)
+    # 按日期和入库时间排序，每组最后一条即为最新价格
+    query = query.order_by(rollup.product_name, rollup.delivery_date, rollup.last_ingested)
+
+    group_column = PRICE_GROUP_COLUMNS[group_by]
+    groups = {name: {} for name in product_names}
+    for row in db.execute(query).scalars():
+        key = getattr(row, group_column)
+        stats = groups[row.product_name].get(key)
+        if stats is None:
+            groups[row.product_name][key] = stats = {
+                'record_count': 0, 'price_sum': Decimal(0),
+                'min_price': row.min_price, 'max_price': row.max_price
+            }
+        stats['record_count'] += row.record_count
+        stats['price_sum'] += row.price_sum
+        stats['min_price'] = min(stats['min_price'], row.min_price)
+        stats['max_price'] = max(stats['max_price'], row.max_price)
+        stats['latest_price'] = row.latest_price
+        stats['latest_date'] = row.delivery_date
+
+    result = {}
+    for product_name, product_groups in groups.items():
+        result[product_name] = [
+            {
+                group_by: key.strftime('%Y-%m-%d') if group_by == 'day' else key,
+                'min_price': float(stats['min_price']),
+                'max_price': float(stats['max_price']),
+                'avg_price': round(float(stats['price_sum']) / stats['record_count'], 4),
+                'latest_price': float(stats['latest_price']),
+                'latest_date': stats['latest_date'].strftime('%Y-%m-%d'),
+                'record_count': stats['record_count']
+            }
+            for key, stats in sorted(product_groups.items())
+        ]
+    return result
+
+
+@router.get("/prices/{product_name}")
+async def get_price_history(request: Request, product_name: str,
+                            group_by: str = Query('day', pattern='^(day|delivery_unit|ordering_unit)$',
+                                                  description="分组方式：day / delivery_unit / ordering_unit"),
+                            start_date: Optional[date] = Query(None, description="送货日期起（含）"),
+                            end_date: Optional[date] = Query(None, description="送货日期止（含）"),
+                            db=Depends(get_db)):
+    """商品的结算价历史"""
+    async def compute():
+        try:
+            history = (await run_db(db, query_price_rollups, [product_name], group_by, start_date, end_date))[product_name]
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"查询数据库时出错: {str(e)}")
+        return {"product_name": product_name, "group_by": group_by, "count": len(history), "items": history}
+
+    return await cached_json_response(request, compute)
+
+
+@router.get("/compare")
+async def compare_prices(request: Request,
+                         products: List[str] = Query(..., description="要比较的商品名称，可重复传入"),
+                         group_by: str = Query('delivery_unit', pattern='^(day|delivery_unit|ordering_unit)$',
+                                               description="分组方式：day / delivery_unit / ordering_unit"),
+                         start_date: Optional[date] = Query(None, description="送货日期起（含）"),
+                         end_date: Optional[date] = Query(None, description="送货日期止（含）"),
+                         db=Depends(get_db)):
+    """比较多个商品在不同送货单位（供应商）、订货单位或日期的结算价"""
+    if len(products) > 100:
+        raise HTTPException(status_code=400, detail="最多只能比较100个商品")
+
+    async def compute():
+        try:
+            comparison = await run_db(db, query_price_rollups, list(dict.fromkeys(products)), group_by,
+                                      start_date, end_date)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"查询数据库时出错: {str(e)}")
+        return {"group_by": group_by, "products": comparison}
+
+    return await cached_json_response(request, compute)
 
 
-@app.delete("/delete/{filename}")
+@router.delete("/delete/{filename}")
 async def delete_file(filename: str):
-    file_path = os.path.join(UPLOAD_DIR, filename)
+    try:
+        unreferenced = await run_in_threadpool(unregister_upload, filename)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"删除文件时出错: {str(e)}")
 
-    if not os.path.exists(file_path):
+    # 不在清单中的文件：按文件名直接保存在 UPLOAD_DIR 下的旧文件
+    file_path = os.path.join(UPLOAD_DIR, filename)
+    if unreferenced is None and not os.path.isfile(file_path):
         raise HTTPException(status_code=404, detail="文件不存在")
 
     try:
-        os.remove(file_path)
+        if unreferenced is None:
+            remove_files([file_path])
+        else:
+            remove_objects(unreferenced)
+        bump_ingest_generation()
         return {"message": f"文件 {filename} 已删除", "filename": filename}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除文件时出错: {str(e)}")
 
 
-@app.get("/files")
-async def list_files():
-    if not os.path.exists(UPLOAD_DIR):
-        return {"files": []}
-
-    files = [f for f in os.listdir(UPLOAD_DIR)
-             if os.path.isfile(os.path.join(UPLOAD_DIR, f))]
-    return {"files": files}
+def list_upload_names(db) -> List[str]:
+    """清单中的文件名，按上传时间排序"""
+    table = UploadManifest.__table__
+    return list(db.execute(select(table.c.file_name).order_by(table.c.uploaded_time, table.c.file_name)).scalars())
+
+
+@router.get("/files")
+async def list_files(request: Request, db=Depends(get_db)):
+    async def compute():
+        files = await run_db(db, list_upload_names)
+
+        # 按文件名直接保存在 UPLOAD_DIR 下的旧文件
+        if os.path.exists(UPLOAD_DIR):
+            listed = set(files)
+            files += [f for f in os.listdir(UPLOAD_DIR)
+                      if os.path.isfile(os.path.join(UPLOAD_DIR, f)) and not f.startswith('.upload-')
+                      and f not in listed]
+        return {"files": files}
+
+    return await cached_json_response(request, compute)
+
+
+def query_plan_statements() -> Dict[str, Any]:
+    """主要查询场景的 SQL，用于检查执行计划是否使用了索引"""
+    table = HongshanShixiaoDelivery
+    return {
+        'price_inconsistencies': (
+            select(PriceSummary.delivery_date, PriceSummary.product_name)
+            .where(PriceSummary.price_count > 1)
+        ),
+        'price_summary_rebuild': (
+            select(table.delivery_date, table.product_name, table.settlement_price, func.count())
+            .group_by(table.delivery_date, table.product_name, table.settlement_price)
+        ),
+        'price_history': (
+            select(table.delivery_date, table.settlement_price)
+            .where(table.product_name == '示例商品')
+            .order_by(table.delivery_date)
+        ),
+        'file_cleanup': select(table.id).where(table.file_name == '示例.xlsx'),
+    }
 
 
-@app.get("/test-db")
-async def test_db():
+def check_query_plans(bind=None) -> Dict[str, Dict[str, Any]]:
+    """对主要查询执行 EXPLAIN，返回每个查询的执行计划以及是否使用了索引"""
+    bind = bind or get_engine()
+    results = {}
+    with bind.connect() as conn:
+        is_sqlite = conn.dialect.name == 'sqlite'
+        for name, statement in query_plan_statements().items():
+            sql = str(statement.compile(conn, compile_kwargs={'literal_binds': True}))
+            rows = [dict(row._mapping) for row in
+                    conn.exec_driver_sql(('EXPLAIN QUERY PLAN ' if is_sqlite else 'EXPLAIN ') + sql)]
+            if is_sqlite:
+                uses_index = all('INDEX' in row['detail'] for row in rows if row['detail'].startswith(('SCAN', 'SEARCH')))
+            else:
+                uses_index = all(row.get('key') for row in rows)
+            results[name] = {'uses_index': uses_index, 'plan': rows}
+    return results
+
+
+def write_test_record(db) -> Tuple[int, int]:
+    """插入一条测试记录，返回插入前后的记录数
+
+    测试记录和上传的文件一样经过 save_file_to_database 入库，价格汇总表同步更新。
+    """
+    # 测试查询
+    count = db.query(HongshanShixiaoDelivery).count()
+    print(f"当前记录数: {count}")
+
+    # 测试插入
+    save_file_to_database("test.xlsx", [{
+        'info': {
+            'delivery_date': datetime.now().date(),
+            'order_unit': "测试单位",
+            'delivery_unit': "测试送货单位"
+        },
+        'products': [{
+            'serial_number': 1,
+            'product_name': "测试商品",
+            'specification': "",
+            'quantity': 10.0,
+            'unit': "个",
+            'supplier_price': 100.0,
+            'discount_rate': 10.0,
+            'settlement_price': 90.0,
+            'amount': 900.0
+        }]
+    }])
+
+    # 结束查询所在的事务，读到另一个连接刚提交的记录
+    db.rollback()
+    new_count = db.query(HongshanShixiaoDelivery).count()
+    print(f"插入后记录数: {new_count}")
+    return count, new_count
+
+
+@router.get("/test-db")
+async def test_db(db=Depends(get_db)):
     """测试数据库连接和插入功能"""
     try:
-        db = SessionLocal()
-
-        # 测试查询
-        count = db.query(HongshanShixiaoDelivery).count()
-        print(f"当前记录数: {count}")
-
-        # 测试插入
-        test_record = HongshanShixiaoDelivery(
-            file_name="test.xlsx",
-            delivery_date=datetime.now().date(),
-            ordering_unit="测试单位",
-            delivery_unit="测试送货单位",
-            serial_number=1,
-            product_name="测试商品",
-            specification="",
-            quantity=10.0,
-            unit="个",
-            supplier_price=100.0,
-            discount_rate=10.0,
-            settlement_price=90.0,
-            amount=900.0
-        )
-        db.add(test_record)
-        db.commit()
-
-        new_count = db.query(HongshanShixiaoDelivery).count()
-        print(f"插入后记录数: {new_count}")
-
+        count, new_count = await run_db(db, write_test_record)
+        bump_ingest_generation()
         return {"status": "success", "message": f"数据库测试成功，记录数: {count} -> {new_count}"}
     except Exception as e:
         print(f"数据库测试失败: {str(e)}")
         return {"status": "error", "message": str(e)}
-    finally:
-        db.close()
 
-if __name__ == "__main__":
-    import uvicorn
+# 启动时是否执行数据库迁移（多个进程共用一个数据库时可只在一个进程中执行）
+MIGRATE_ON_STARTUP = os.getenv('MIGRATE_ON_STARTUP', '1').lower() not in ('0', 'false', 'no')
+
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """启动时创建上传目录、数据库引擎并执行迁移，关闭时释放进程池和连接池"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    if MIGRATE_ON_STARTUP:
+        await run_in_threadpool(run_migrations, get_engine())
+    yield
+    shutdown_ingest_pool()
+    await dispose_async_engine()
+    dispose_engines()
+
+
+def create_app() -> FastAPI:
+    """创建 FastAPI 应用（uvicorn exceldemo3:create_app --factory）"""
+    application = FastAPI(lifespan=lifespan)
+    application.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    application.include_router(router)
+    return application
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+
+    if command == 'migrate':
+        # python exceldemo3.py migrate
+        print(f"执行的迁移: {run_migrations(get_engine())}")
+    elif command == 'rebuild-summary':
+        # python exceldemo3.py rebuild-summary：回填或修复价格汇总表
+        rebuild_price_summary(get_engine())
+        rebuild_price_rollups(get_engine())
+        print("价格汇总表已重建")
+    elif command == 'build-parsed-cache':
+        # python exceldemo3.py build-parsed-cache [目录]：为已保存的 Excel 文件生成解析结果的列式缓存
+        if not parsed_cache_enabled():
+            sys.exit("解析缓存未启用：需要安装 pyarrow，且 PARSED_CACHE 不为 0")
+        print(f"生成解析缓存: {build_parsed_cache(sys.argv[2] if len(sys.argv) > 2 else None)}")
+    elif command == 'replay-parsed-cache':
+        # python exceldemo3.py replay-parsed-cache：从解析缓存重建数据库记录，不解析 Excel
+        if not parsed_cache_enabled():
+            sys.exit("解析缓存未启用：需要安装 pyarrow，且 PARSED_CACHE 不为 0")
+        print(f"从解析缓存重建记录: {replay_parsed_cache()}")
+    elif command == 'explain':
+        # python exceldemo3.py explain：检查迁移前后主要查询的执行计划
+        for name, plan in check_query_plans(get_engine()).items():
+            print(f"{name}: {'使用索引' if plan['uses_index'] else '全表扫描'}")
+            for row in plan['plan']:
+                print(f"    {row}")
+    else:
+        import uvicorn
+
+        uvicorn.run(app, host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", 8000)))
\ No newline at end of file
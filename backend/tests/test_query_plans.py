@@ -0,0 +1,62 @@
+"""数据库迁移与查询执行计划的测试：迁移 2 创建的索引应被主要查询使用"""
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exceldemo3  # noqa: E402
+
+ALL_MIGRATIONS = list(exceldemo3.MIGRATIONS)
+
+# 只涉及 hongshan_shixiao_delivery 表的查询，迁移 1、2 之后即可执行
+DELIVERY_QUERIES = ('price_summary_rebuild', 'price_history', 'file_cleanup')
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'query_plans.db'}")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def delivery_queries(monkeypatch):
+    statements = exceldemo3.query_plan_statements()
+    monkeypatch.setattr(exceldemo3, 'query_plan_statements',
+                        lambda: {name: statements[name] for name in DELIVERY_QUERIES})
+
+
+def run_migrations_until(engine, monkeypatch, version):
+    monkeypatch.setattr(exceldemo3, 'MIGRATIONS',
+                        [m for m in ALL_MIGRATIONS if m[0] <= version])
+    return exceldemo3.run_migrations(engine)
+
+
+def test_delivery_indexes_are_used(engine, monkeypatch, delivery_queries):
+    assert run_migrations_until(engine, monkeypatch, 1) == [1]
+    # 新库上迁移 1 建表时会一并创建索引，删除索引以模拟加索引之前创建的旧库
+    with engine.begin() as conn:
+        for index in exceldemo3.HongshanShixiaoDelivery.__table__.indexes:
+            index.drop(conn)
+    plans = exceldemo3.check_query_plans(engine)
+    for name in DELIVERY_QUERIES:
+        assert not plans[name]['uses_index'], plans[name]['plan']
+        assert any(row['detail'].startswith('SCAN') for row in plans[name]['plan'])
+
+    assert run_migrations_until(engine, monkeypatch, 2) == [2]
+    plans = exceldemo3.check_query_plans(engine)
+    for name in DELIVERY_QUERIES:
+        assert plans[name]['uses_index'], plans[name]['plan']
+
+
+def test_run_migrations_is_idempotent(engine):
+    executed = exceldemo3.run_migrations(engine)
+    assert executed == [version for version, _, _ in exceldemo3.MIGRATIONS]
+    assert exceldemo3.run_migrations(engine) == []
+
+    plans = exceldemo3.check_query_plans(engine)
+    assert set(plans) == set(exceldemo3.query_plan_statements())
+    assert all(plan['uses_index'] for plan in plans.values()), plans
@@ -11,6 +11,13 @@ interface ServerFile {
   name: string;
 }
 
+interface JobFile {
+  file_name: string;
+  state: string;
+  duplicate_of: string | null;
+  error: string | null;
+}
+
 export default function Home() {
   const [fileItems, setFileItems] = useState<FileItem[]>([]);
   const [serverFiles, setServerFiles] = useState<ServerFile[]>([]);
@@ -91,6 +98,25 @@ export default function Home() {
     if (fileInput) fileInput.value = '';
   };
 
+// 上传后文件在后台处理，轮询任务进度直到处理完成
+const waitForJob = async (jobId: string) => {
+  while (true) {
+    await new Promise(resolve => setTimeout(resolve, 1000));
+    const response = await fetch(`http://localhost:8000/jobs/${jobId}`);
+    const job = await response.json();
+    if (!response.ok) {
+      throw new Error(job.detail || '查询处理进度失败');
+    }
+    if (job.state === 'done') {
+      return job;
+    }
+    const finished = job.files.filter(
+      (f: JobFile) => !['queued', 'parsing', 'saving'].includes(f.state)
+    ).length;
+    setMessage(`文件上传成功，正在处理: ${finished}/${job.files.length}`);
+  }
+};
+
 const handleSubmit = async (e: React.FormEvent) => {
   e.preventDefault();
   
@@ -122,18 +148,22 @@ const handleSubmit = async (e: React.FormEvent) => {
       if (fileInput) fileInput.value = '';
       
       // 显示处理结果
-      if (data.process_results) {
-        const successCount = data.process_results.filter((r: any) => r.saved_to_db).length;
-        const errorCount = data.process_results.length - successCount;
-        
-        setMessage(`处理完成: ${successCount}个成功, ${errorCount}个失败`);
-        
+      const job = await waitForJob(data.job_id);
+      const files: JobFile[] = job.files;
+      const successCount = files.filter(f => f.state === 'done').length;
+      const skippedFiles = files.filter(f => f.state === 'skipped');
+      const errorFiles = files.filter(f => f.state === 'failed');
+      const skippedText = skippedFiles.length > 0
+        ? `, ${skippedFiles.length}个内容重复已跳过 (` +
+          skippedFiles.map(f => `${f.file_name} 与 ${f.duplicate_of} 相同`).join('; ') + ')'
+        : '';
+
+      if (errorFiles.length > 0) {
         // 显示失败的文件和原因
-        const errorFiles = data.process_results.filter((r: any) => r.error);
-        if (errorFiles.length > 0) {
-          setMessage(prev => prev + '\n失败文件: ' + 
-            errorFiles.map((f: any) => `${f.file_name}: ${f.error}`).join('; '));
-        }
+        setMessage(`处理完成: ${successCount}个已保存, ${errorFiles.length}个失败${skippedText}` +
+          '\n失败文件: ' + errorFiles.map(f => `${f.file_name}: ${f.error || '未知错误'}`).join('; '));
+      } else {
+        setMessage(`处理完成: ${successCount}个成功${skippedText}`);
       }
       
       await fetchServerFiles();